@@ -1,7 +1,7 @@
 from layers import *
 from models import Model
 
-def MNISTNet():
+def MNISTNet(dtype=np.float64, layout='NCHW'):
     conv1_params={
         'kernel_h': 3,
         'kernel_w': 3,
@@ -32,7 +32,7 @@ def MNISTNet():
         'stride': 2,
         'pad': 0
     }
-    model = Model()
+    model = Model(dtype=dtype, layout=layout)
     model.add(Convolution(conv1_params, name='conv1', initializer=Guassian(std=0.001)))
     model.add(ReLU(name='relu1'))
     model.add(Pooling(pool1_params, name='pooling1'))
@@ -0,0 +1,44 @@
+"""
+FFT convolution against im2col+GEMM over kernel sizes, forward and
+forward+backward, with the choice the 'auto' backend makes for each case.
+"""
+
+import numpy as np
+from common import best_time
+from layers import Convolution
+
+# (name, input shape, out channels)
+CASES = [
+    ('mnist', (32, 1, 28, 28), 6),
+    ('mnist conv2', (32, 6, 13, 13), 16),
+    ('cifar', (16, 16, 32, 32), 16),
+]
+KERNELS = (3, 5, 7, 11)
+
+
+def step(layer, x, in_grads):
+    layer.forward(x)
+    layer.backward(in_grads, x)
+
+
+def main():
+    print('%-12s %6s %6s %12s %12s %8s %12s %12s %8s' % ('case', 'kernel', 'auto', 'im2col(ms)', 'fft(ms)', 'speedup', 'im2col step', 'fft step', 'speedup'))
+    for name, shape, K in CASES:
+        for k in KERNELS:
+            params = {'kernel_h': k, 'kernel_w': k, 'pad': k // 2, 'stride': 1, 'in_channel': shape[1], 'out_channel': K}
+            reference = Convolution(dict(params, backend='im2col'))
+            fft = Convolution(dict(params, backend='fft'))
+            fft.weights[...] = reference.weights
+            x = np.random.randn(*shape)
+            y = reference.forward(x)
+            in_grads = np.random.randn(*y.shape)
+            assert np.allclose(y, fft.forward(x))
+            times = [best_time(lambda: layer.forward(x), repeat=3) for layer in (reference, fft)]
+            steps = [best_time(lambda: step(layer, x, in_grads), repeat=3) for layer in (reference, fft)]
+            choice = Convolution(params).get_backend(shape)
+            print('%-12s %6d %6s %12.2f %12.2f %7.2fx %12.2f %12.2f %7.2fx' % (
+                name, k, choice, times[0]*1e3, times[1]*1e3, times[0]/times[1], steps[0]*1e3, steps[1]*1e3, steps[0]/steps[1]))
+
+
+if __name__ == '__main__':
+    main()
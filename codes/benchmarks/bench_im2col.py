@@ -0,0 +1,42 @@
+"""
+Compare the fancy-indexing and the sliding-window im2col engines, and the
+np.add.at and strided-slice col2im kernels.
+"""
+
+import numpy as np
+from common import best_time
+from im2col import im2col_indices, im2col_strided, col2im_indices, col2im_slices
+
+# (name, input shape, field height, field width, padding, stride)
+CASES = [
+    ('mnist conv1', (32, 1, 28, 28), 3, 3, 0, 1),
+    ('mnist conv2', (32, 6, 13, 13), 3, 3, 0, 1),
+    ('mnist pool1', (32*6, 1, 26, 26), 2, 2, 0, 2),
+    ('mnist pool2', (32*16, 1, 11, 11), 3, 3, 0, 2),
+    ('cifar conv1', (64, 3, 32, 32), 3, 3, 1, 1),
+    ('cifar conv2', (64, 32, 32, 32), 3, 3, 1, 1),
+    ('cifar conv5x5', (64, 32, 16, 16), 5, 5, 2, 1),
+]
+
+
+def main():
+    print('%-14s %12s %12s %8s' % ('case', 'indices(ms)', 'strided(ms)', 'speedup'))
+    for name, shape, fh, fw, pad, stride in CASES:
+        x = np.random.randn(*shape)
+        assert np.array_equal(im2col_indices(x, fh, fw, pad, stride), im2col_strided(x, fh, fw, pad, stride))
+        t_indices = best_time(lambda: im2col_indices(x, fh, fw, pad, stride))
+        t_strided = best_time(lambda: im2col_strided(x, fh, fw, pad, stride))
+        print('%-14s %12.3f %12.3f %7.2fx' % (name, t_indices*1e3, t_strided*1e3, t_indices/t_strided))
+
+    print()
+    print('%-14s %12s %12s %8s' % ('case', 'add.at(ms)', 'slices(ms)', 'speedup'))
+    for name, shape, fh, fw, pad, stride in CASES:
+        cols = im2col_strided(np.random.randn(*shape), fh, fw, pad, stride)
+        assert np.allclose(col2im_indices(cols, shape, fh, fw, pad, stride), col2im_slices(cols, shape, fh, fw, pad, stride))
+        t_indices = best_time(lambda: col2im_indices(cols, shape, fh, fw, pad, stride))
+        t_slices = best_time(lambda: col2im_slices(cols, shape, fh, fw, pad, stride))
+        print('%-14s %12.3f %12.3f %7.2fx' % (name, t_indices*1e3, t_slices*1e3, t_indices/t_slices))
+
+
+if __name__ == '__main__':
+    main()
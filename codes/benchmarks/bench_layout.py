@@ -0,0 +1,68 @@
+"""
+Layer-by-layer NCHW against CHWN (channel, height, width, batch) activations,
+forward and forward+backward, plus a full MNISTNet training step in each
+layout. In CHWN the convolution GEMM output and the pooling reductions are
+already in the layout the next layer reads, so their transposes disappear.
+"""
+
+import numpy as np
+from common import best_time
+from applications import MNISTNet
+from layers import Convolution, ReLU, Pooling, Flatten
+from loss import SoftmaxCrossEntropy
+from optimizers import Adam
+
+BATCH = 64
+CONV = {'kernel_h': 3, 'kernel_w': 3, 'pad': 1, 'stride': 1, 'in_channel': 16, 'out_channel': 32}
+POOL = {'pool_type': 'max', 'pool_height': 2, 'pool_width': 2, 'stride': 2, 'pad': 0}
+
+# (name, layer factory, input shape in NCHW)
+LAYERS = [
+    ('convolution', lambda: Convolution(CONV), (BATCH, 16, 28, 28)),
+    ('relu', ReLU, (BATCH, 32, 28, 28)),
+    ('pooling', lambda: Pooling(POOL), (BATCH, 32, 28, 28)),
+    ('flatten', Flatten, (BATCH, 32, 14, 14)),
+]
+
+
+def step(layer, x, in_grads):
+    layer.forward(x)
+    layer.backward(in_grads, x)
+
+
+def train_step(model, x, y, state):
+    model.forward(x, y)
+    model.backward(y)
+    model.update(model.optimizer, state['iteration'])
+    state['iteration'] += 1
+
+
+def main():
+    print('batch=%d' % BATCH)
+    print('%-14s %12s %12s %8s %12s %12s %8s' % ('layer', 'NCHW fwd', 'CHWN fwd', 'speedup', 'NCHW step', 'CHWN step', 'speedup'))
+    for name, make, shape in LAYERS:
+        times = {}
+        for layout in ('NCHW', 'CHWN'):
+            layer = make()
+            layer.set_layout(layout)
+            x = np.random.randn(*shape)
+            if layout == 'CHWN':
+                x = np.ascontiguousarray(x.transpose(1, 2, 3, 0))
+            in_grads = np.random.randn(*layer.forward(x).shape)
+            times[layout] = (best_time(lambda: layer.forward(x), repeat=3), best_time(lambda: step(layer, x, in_grads), repeat=3))
+        (f0, s0), (f1, s1) = times['NCHW'], times['CHWN']
+        print('%-14s %12.3f %12.3f %7.2fx %12.3f %12.3f %7.2fx' % (name, f0*1e3, f1*1e3, f0/f1, s0*1e3, s1*1e3, s0/s1))
+
+    x = np.random.rand(BATCH, 1, 28, 28)
+    y = np.random.randint(10, size=BATCH)
+    steps = {}
+    for layout in ('NCHW', 'CHWN'):
+        model = MNISTNet(layout=layout)
+        model.compile(Adam(inplace=True), SoftmaxCrossEntropy(10))
+        state = {'iteration': 0}
+        steps[layout] = best_time(lambda: train_step(model, x, y, state), repeat=3)
+    print('%-14s %12s %12s %8s %12.3f %12.3f %7.2fx' % ('mnistnet', '', '', '', steps['NCHW']*1e3, steps['CHWN']*1e3, steps['NCHW']/steps['CHWN']))
+
+
+if __name__ == '__main__':
+    main()
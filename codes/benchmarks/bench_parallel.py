@@ -0,0 +1,57 @@
+"""
+Scaling of data-parallel MNISTNet training steps with 1/2/4/8 worker processes.
+"""
+
+import time
+import numpy as np
+import common  # puts codes/ on sys.path
+from applications import MNISTNet
+from loss import SoftmaxCrossEntropy
+from optimizers import Adam
+from parallel import DataParallel
+
+BATCH = 512
+STEPS = 10
+
+
+def step_time(workers):
+    np.random.seed(0)
+    model = MNISTNet()
+    model.compile(Adam(inplace=True), SoftmaxCrossEntropy(10))
+    x = np.random.rand(BATCH, 1, 28, 28)
+    y = np.random.randint(0, 10, BATCH)
+
+    if workers == 1:
+        def forward_backward(x, y):
+            loss, probs = model.forward(x, y)
+            model.backward(y)
+            return loss, probs
+        parallel = None
+    else:
+        parallel = DataParallel(model, workers).start()
+        forward_backward = parallel.forward_backward
+
+    try:
+        forward_backward(x, y)
+        start = time.perf_counter()
+        for iteration in range(STEPS):
+            forward_backward(x, y)
+            model.update(model.optimizer, iteration+1)
+        return (time.perf_counter() - start) / STEPS
+    finally:
+        if parallel:
+            parallel.close()
+
+
+def main():
+    print('batch=%d' % BATCH)
+    print('%8s %12s %8s' % ('workers', 'step(ms)', 'speedup'))
+    base = None
+    for workers in (1, 2, 4, 8):
+        t = step_time(workers)
+        base = base or t
+        print('%8d %12.2f %7.2fx' % (workers, t*1e3, base/t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Pooling through im2col against the direct strided-view kernels in pooling.py,
+forward (inference, no argmax kept) and forward+backward, for max and average
+pooling with non-overlapping and overlapping windows, in both layouts.
+"""
+
+import numpy as np
+from common import best_time
+from layers import Pooling
+
+SHAPE = (64, 32, 28, 28)
+# (pool_height/pool_width, stride, pad)
+WINDOWS = [(2, 2, 0), (3, 2, 0), (3, 1, 1)]
+
+
+def step(layer, x, in_grads):
+    layer.forward(x)
+    layer.backward(in_grads, x)
+
+
+def main():
+    print('input=%s' % (SHAPE,))
+    print('%-22s %12s %12s %8s %12s %12s %8s' % ('case', 'im2col fwd', 'direct fwd', 'speedup', 'im2col step', 'direct step', 'speedup'))
+    for layout in ('NCHW', 'CHWN'):
+        x = np.random.randn(*SHAPE)
+        if layout == 'CHWN':
+            x = np.ascontiguousarray(x.transpose(1, 2, 3, 0))
+        for pool_type in ('max', 'avg'):
+            for size, stride, pad in WINDOWS:
+                times = {}
+                for backend in ('im2col', 'direct'):
+                    layer = Pooling({'pool_type': pool_type, 'pool_height': size, 'pool_width': size, 'stride': stride, 'pad': pad, 'backend': backend})
+                    layer.set_layout(layout)
+                    layer.set_cache(True)
+                    in_grads = np.random.randn(*layer.forward(x).shape)
+                    layer.training = False
+                    forward = best_time(lambda: layer.forward(x), repeat=3)
+                    layer.training = True
+                    times[backend] = (forward, best_time(lambda: step(layer, x, in_grads), repeat=3))
+                (f0, s0), (f1, s1) = times['im2col'], times['direct']
+                name = '%s %s %dx%d/%d' % (layout, pool_type, size, size, stride)
+                print('%-22s %12.3f %12.3f %7.2fx %12.3f %12.3f %7.2fx' % (name, f0*1e3, f1*1e3, f0/f1, s0*1e3, s1*1e3, s0/s1))
+
+
+if __name__ == '__main__':
+    main()
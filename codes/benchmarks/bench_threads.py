@@ -0,0 +1,34 @@
+"""
+Batch-sharded Convolution/Pooling forward+backward against the single-threaded path.
+"""
+
+import numpy as np
+from common import best_time
+from layers import Convolution, Pooling
+
+BATCH = 256
+CONV = {'kernel_h': 3, 'kernel_w': 3, 'pad': 1, 'stride': 1, 'in_channel': 16, 'out_channel': 32, 'im2col': 'strided'}
+POOL = {'pool_type': 'max', 'pool_height': 2, 'pool_width': 2, 'stride': 2, 'pad': 0, 'im2col': 'strided'}
+
+
+def step(layer, x, in_grads):
+    layer.forward(x)
+    layer.backward(in_grads, x)
+
+
+def main():
+    x = np.random.randn(BATCH, 16, 28, 28)
+    print('batch=%d' % BATCH)
+    print('%-12s %8s %12s %8s' % ('layer', 'threads', 'time(ms)', 'speedup'))
+    for name, cls, params in (('convolution', Convolution, CONV), ('pooling', Pooling, POOL)):
+        base = None
+        for threads in (1, 2, 4, 8):
+            layer = cls(dict(params, threads=threads))
+            in_grads = np.random.randn(*layer.forward(x).shape)
+            t = best_time(lambda: step(layer, x, in_grads), repeat=3)
+            base = base or t
+            print('%-12s %8d %12.2f %7.2fx' % (name, threads, t*1e3, base/t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Winograd F(2x2,3x3) against im2col+GEMM for the forward pass and the
+gradients to the inputs of 3x3 stride-1 convolutions.
+"""
+
+import numpy as np
+from common import best_time
+from im2col import im2col, col2im
+import winograd
+
+# (name, input shape, out channels, padding)
+CASES = [
+    ('mnist conv1', (32, 1, 28, 28), 6, 0),
+    ('mnist conv2', (32, 6, 13, 13), 16, 0),
+    ('cifar conv1', (64, 3, 32, 32), 32, 1),
+    ('cifar conv2', (64, 32, 32, 32), 32, 1),
+    ('cifar conv3', (64, 64, 16, 16), 64, 1),
+]
+
+
+def im2col_forward(x, w, pad):
+    K = w.shape[0]
+    N, _, H, W = x.shape
+    out = w.reshape(K, -1) @ im2col(x, 3, 3, pad, 1)
+    return out.reshape(K, H + 2 * pad - 2, W + 2 * pad - 2, N).transpose(3, 0, 1, 2)
+
+
+def im2col_input_grads(g, w, x_shape, pad):
+    K = w.shape[0]
+    dX_col = w.reshape(K, -1).T @ g.transpose(1, 2, 3, 0).reshape(K, -1)
+    return col2im(dX_col, x_shape, 3, 3, pad, 1)
+
+
+def main():
+    print('%-12s %-10s %12s %12s %8s' % ('case', 'pass', 'im2col(ms)', 'winograd(ms)', 'speedup'))
+    for name, shape, K, pad in CASES:
+        x = np.random.randn(*shape)
+        w = np.random.randn(K, shape[1], 3, 3)
+        y = im2col_forward(x, w, pad)
+        g = np.random.randn(*y.shape)
+        assert np.allclose(y, winograd.conv2d(x, w, pad=pad))
+        assert np.allclose(im2col_input_grads(g, w, shape, pad), winograd.conv2d_input_grads(g, w, pad))
+        for label, reference, fast in (
+                ('forward', lambda: im2col_forward(x, w, pad), lambda: winograd.conv2d(x, w, pad=pad)),
+                ('dinputs', lambda: im2col_input_grads(g, w, shape, pad), lambda: winograd.conv2d_input_grads(g, w, pad))):
+            t_ref = best_time(reference, repeat=3)
+            t_fast = best_time(fast, repeat=3)
+            print('%-12s %-10s %12.3f %12.3f %7.2fx' % (name, label, t_ref * 1e3, t_fast * 1e3, t_ref / t_fast))
+
+
+if __name__ == '__main__':
+    main()
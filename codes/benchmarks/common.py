@@ -0,0 +1,25 @@
+"""
+Shared helpers for the benchmark scripts.
+
+Run the scripts from the `codes` directory, e.g. `python benchmarks/bench_im2col.py`.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def best_time(func, repeat=5, number=None):
+    """Return the best per-call time of func in seconds
+
+    # Arguments
+        func: callable without arguments
+        repeat: int, the number of timing rounds
+        number: int, calls per round (None to pick it automatically, aiming at ~0.2s per round)
+    """
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
@@ -0,0 +1,275 @@
+"""
+Benchmark suite over layers, im2col/col2im, optimizers and an end-to-end
+MNISTNet training step.
+
+    python benchmarks/suite.py run --out base.json [--quick] [--filter conv]
+    python benchmarks/suite.py compare base.json new.json [--threshold 0.1]
+
+`run` writes the best per-call time of every case together with the machine
+it ran on. `compare` lines up two runs case by case and exits with status 1
+if any case got slower by more than the threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from common import best_time
+from applications import MNISTNet
+from im2col import im2col_indices, col2im_indices
+from layers import Convolution, Pooling, FCLayer, ReLU
+from loss import SoftmaxCrossEntropy
+from optimizers import SGD, Adam, Adagrad, RMSprop
+
+BATCHES = (16, 64)
+QUICK_BATCHES = (16,)
+
+# (in channels, out channels, input size, kernel, stride, pad)
+CONVS = [
+    (1, 6, 28, 3, 1, 0),
+    (6, 16, 13, 3, 1, 0),
+    (16, 32, 16, 3, 1, 1),
+    (16, 32, 16, 5, 1, 2),
+    (16, 32, 16, 3, 2, 1),
+]
+
+# (pool type, channels, input size, pool size, stride)
+POOLS = [
+    ('max', 6, 26, 2, 2),
+    ('max', 16, 11, 3, 2),
+    ('avg', 16, 16, 2, 2),
+]
+
+# (in features, out features)
+FCS = [(400, 100), (784, 256)]
+
+OPTIMIZERS = [
+    ('sgd', lambda inplace: SGD(lr=0.01, momentum=0.9, inplace=inplace)),
+    ('adam', lambda inplace: Adam(inplace=inplace)),
+    ('adagrad', lambda inplace: Adagrad(inplace=inplace)),
+    ('rmsprop', lambda inplace: RMSprop(inplace=inplace)),
+]
+
+
+def machine_info():
+    info = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    try:
+        info['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def layer_step(layer, x, in_grads):
+    layer.forward(x)
+    layer.backward(in_grads, x)
+
+
+# every bench_* generator yields (name, make): make() does the setup and returns the
+# function to time, so cases left out by --filter cost nothing
+
+
+def layer_cases(batches):
+    for batch in batches:
+        for cin, cout, size, k, stride, pad in CONVS:
+            params = {'kernel_h': k, 'kernel_w': k, 'pad': pad, 'stride': stride, 'in_channel': cin, 'out_channel': cout}
+            name = 'conv/b%d_c%d-%d_s%d_k%d_st%d_p%d' % (batch, cin, cout, size, k, stride, pad)
+            yield name, lambda params=params: Convolution(params), (batch, cin, size, size)
+        for mode, channels, size, k, stride in POOLS:
+            params = {'pool_type': mode, 'pool_height': k, 'pool_width': k, 'stride': stride, 'pad': 0}
+            name = 'pool/b%d_%s_c%d_s%d_k%d_st%d' % (batch, mode, channels, size, k, stride)
+            yield name, lambda params=params: Pooling(params), (batch, channels, size, size)
+        for fin, fout in FCS:
+            yield 'fc/b%d_%d-%d' % (batch, fin, fout), lambda fin=fin, fout=fout: FCLayer(fin, fout), (batch, fin)
+        yield 'relu/b%d_c16_s26' % batch, ReLU, (batch, 16, 26, 26)
+
+
+def prepare_layer(make_layer, shape):
+    layer = make_layer()
+    layer.set_mode(True)
+    x = np.random.randn(*shape)
+    in_grads = np.random.randn(*layer.forward(x).shape)
+    return layer, x, in_grads
+
+
+def bench_layers(batches):
+    for name, make_layer, shape in layer_cases(batches):
+        def forward(make_layer=make_layer, shape=shape):
+            layer, x, _ = prepare_layer(make_layer, shape)
+            return lambda: layer.forward(x)
+
+        def step(make_layer=make_layer, shape=shape):
+            layer, x, in_grads = prepare_layer(make_layer, shape)
+            return lambda: layer_step(layer, x, in_grads)
+        yield name + '/forward', forward
+        yield name + '/step', step
+
+
+def bench_loss(batches):
+    loss = SoftmaxCrossEntropy(10)
+    for batch in batches:
+        def prepare(batch=batch):
+            return np.random.randn(batch, 10), np.random.randint(10, size=batch)
+
+        def forward(prepare=prepare):
+            x, y = prepare()
+            return lambda: loss.forward(x, y)
+
+        def step(prepare=prepare):
+            x, y = prepare()
+            return lambda: (loss.forward(x, y), loss.backward(x, y))
+        yield 'softmax_ce/b%d/forward' % batch, forward
+        yield 'softmax_ce/b%d/step' % batch, step
+
+
+def bench_im2col(batches):
+    for batch in batches:
+        for cin, _, size, k, stride, pad in CONVS:
+            shape = (batch, cin, size, size)
+            name = 'b%d_c%d_s%d_k%d_st%d_p%d' % (batch, cin, size, k, stride, pad)
+
+            def forward(shape=shape, k=k, stride=stride, pad=pad):
+                x = np.random.randn(*shape)
+                return lambda: im2col_indices(x, k, k, pad, stride)
+
+            def backward(shape=shape, k=k, stride=stride, pad=pad):
+                cols = im2col_indices(np.random.randn(*shape), k, k, pad, stride)
+                return lambda: col2im_indices(cols, shape, k, k, pad, stride)
+            yield 'im2col/' + name, forward
+            yield 'col2im/' + name, backward
+
+
+def bench_optimizers():
+    # MNISTNet-sized parameters, as dictionaries of layer arrays and as one flat array, built on first use
+    models = []
+
+    def mnistnet():
+        if not models:
+            model = MNISTNet()
+            model.compile(SGD(), SoftmaxCrossEntropy(10))
+            models.append(model)
+        return models[0]
+
+    for inplace in (False, True):
+        for name, make in OPTIMIZERS:
+            def prepare(make=make, inplace=inplace):
+                model = mnistnet()
+                optimizer = make(inplace)
+                if inplace:
+                    xs, xs_grads = {'flat': model.flat_params.copy()}, {'flat': model.flat_grads}
+                else:
+                    params, grads = model.collect_params()
+                    xs, xs_grads = {k: v.copy() for k, v in params.items()}, grads
+                state = {'iteration': 1}
+
+                def step():
+                    optimizer.update(xs, xs_grads, state['iteration'])
+                    state['iteration'] += 1
+                return step
+            yield 'optimizer/%s%s' % (name, '_inplace' if inplace else ''), prepare
+
+
+def bench_train_step(batches):
+    for batch in batches:
+        def prepare(batch=batch):
+            np.random.seed(0)
+            model = MNISTNet()
+            model.compile(Adam(), SoftmaxCrossEntropy(10))
+            x = np.random.rand(batch, 1, 28, 28)
+            y = np.random.randint(10, size=batch)
+            state = {'iteration': 0}
+
+            def step():
+                model.forward(x, y)
+                model.backward(y)
+                model.update(model.optimizer, state['iteration'])
+                state['iteration'] += 1
+            return step
+        yield 'mnistnet/b%d/train_step' % batch, prepare
+
+
+def run(args):
+    batches = QUICK_BATCHES if args.quick else BATCHES
+    repeat = 3 if args.quick else 5
+    groups = [
+        bench_layers(batches),
+        bench_loss(batches),
+        bench_im2col(batches),
+        bench_optimizers(),
+        bench_train_step(batches),
+    ]
+    results = {}
+    for group in groups:
+        for name, make in group:
+            if args.filter and args.filter not in name:
+                continue
+            seconds = best_time(make(), repeat=repeat)
+            results[name] = seconds
+            print('%-48s %12.4f ms' % (name, seconds * 1e3))
+            sys.stdout.flush()
+    report = {'machine': machine_info(), 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    return 0
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    for key in ('processor', 'cpu_count', 'numpy'):
+        if base['machine'].get(key) != new['machine'].get(key):
+            print('warning: runs differ in %s (%s vs %s)' % (key, base['machine'].get(key), new['machine'].get(key)))
+    regressions = 0
+    print('%-48s %12s %12s %8s' % ('case', 'base(ms)', 'new(ms)', 'ratio'))
+    for name in sorted(set(base['results']) & set(new['results'])):
+        old_t, new_t = base['results'][name], new['results'][name]
+        ratio = new_t / old_t
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = 'faster'
+        print('%-48s %12.4f %12.4f %7.2fx %s' % (name, old_t * 1e3, new_t * 1e3, ratio, flag))
+    for name in sorted(set(base['results']) ^ set(new['results'])):
+        print('%-48s only in %s' % (name, 'base' if name in base['results'] else 'new'))
+    print('%d regression(s) above %.0f%%' % (regressions, args.threshold * 100))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='time every case and write the results as JSON')
+    run_parser.add_argument('--out', help='JSON file for the results')
+    run_parser.add_argument('--quick', action='store_true', help='smaller grid and fewer repeats')
+    run_parser.add_argument('--filter', help='only cases whose name contains this string')
+    compare_parser = commands.add_parser('compare', help='flag regressions between two runs')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'compare':
+        return compare(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Binary checkpoints of a Model.
+
+Layout of a checkpoint file:
+
+    8 bytes   magic b'CNNCKPT1'
+    8 bytes   little-endian uint64, length of the JSON header
+    n bytes   JSON header: architecture, loss, regularization, optimizer
+              hyperparameters and a table of the arrays (offset, shape, dtype)
+    ...       the arrays, each starting at a multiple of ALIGNMENT bytes
+
+Parameters are stored as the single flat buffer of Model.flat_params, so
+loading with mmap=True maps them straight from the file (copy-on-write), and
+an inference process can start without reading them up front.
+"""
+
+import inspect
+import json
+import os
+import struct
+import threading
+import numpy as np
+import layers as layers_module
+import loss as loss_module
+import optimizers as optimizers_module
+
+MAGIC = b'CNNCKPT1'
+ALIGNMENT = 64
+STATE = ('moments', 'accumulators')
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def get_spec(obj):
+    """Class name and constructor arguments of a loss, regularization or optimizer
+
+    Arguments are the attributes named like constructor parameters; callables
+    such as sheduler_func cannot be stored and are left out.
+    """
+    params = inspect.signature(type(obj).__init__).parameters
+    config = {}
+    for name in params:
+        value = getattr(obj, name, None)
+        if isinstance(value, (bool, int, float, str)):
+            config[name] = value
+    return {'class': type(obj).__name__, 'config': config}
+
+
+def from_spec(module, spec):
+    if spec is None:
+        return None
+    return getattr(module, spec['class'])(**spec['config'])
+
+
+def snapshot_header(model):
+    """Checkpoint header of model: architecture and hyperparameters, no array table yet"""
+    return {
+        'dtype': model.dtype.name,
+        'cache_activations': model.cache_activations,
+        'layout': model.layout,
+        'segments': model.segments,
+        'clip': model.clip,
+        'layers': [{'class': type(layer).__name__, 'config': layer.get_config()} for layer in model.layers[:-1]],
+        'loss': get_spec(model.layers[-1]),
+        'regularization': get_spec(model.regularization) if model.regularization else None,
+        'optimizer': get_spec(model.optimizer),
+        'arrays': {},
+    }
+
+
+def snapshot(model):
+    """Header and arrays of a checkpoint, with the arrays copied so training may go on"""
+    arrays = {'params': np.array(model.flat_params)}
+    for state in STATE:
+        for key, value in (getattr(model.optimizer, state, None) or {}).items():
+            arrays['%s/%s' % (state, key)] = np.array(value)
+    return snapshot_header(model), arrays
+
+
+def write(path, header, arrays):
+    table = header['arrays']
+    offset = 0
+    for name, array in arrays.items():
+        table[name] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+        offset = align(offset + array.nbytes)
+    # array offsets in the table are relative to the start of the data section
+    meta = json.dumps(header).encode('utf-8')
+    data_start = align(len(MAGIC) + 8 + len(meta))
+
+    # write a temporary file and rename it, so a crash never leaves a truncated checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(meta)))
+        f.write(meta)
+        for name, array in arrays.items():
+            f.seek(data_start + table[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def save(model, path, background=False):
+    """Write model parameters, optimizer state and architecture to path
+
+    # Arguments
+        model: Model, a compiled model
+        background: bool, write in a background thread; the arrays are copied
+            first, so training can continue right away
+
+    # Returns
+        thread: threading.Thread doing the write (already joined if background is False)
+    """
+    header, arrays = snapshot(model)
+    thread = threading.Thread(target=write, args=(path, header, arrays))
+    thread.start()
+    if not background:
+        thread.join()
+    return thread
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a checkpoint' % path)
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+    return header, align(len(MAGIC) + 8 + size)
+
+
+def load(path, mmap=True):
+    """Rebuild a compiled Model from a checkpoint
+
+    # Arguments
+        mmap: bool, map the arrays from the file (copy-on-write) instead of reading them into memory
+
+    # Returns
+        model: Model
+    """
+    header, data_start = read_header(path)
+    arrays = {}
+    with open(path, 'rb') as f:
+        for name, info in header['arrays'].items():
+            dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+            if mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=data_start + info['offset'], shape=shape)
+            else:
+                f.seek(data_start + info['offset'])
+                arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    model = build(header)
+    # adopt the stored buffer instead of the freshly initialized parameters
+    model.pack_params(arrays['params'], model.flat_grads, copy=False)
+
+    for state in STATE:
+        prefix = state + '/'
+        values = dict((name[len(prefix):], array) for name, array in arrays.items() if name.startswith(prefix))
+        if values:
+            setattr(model.optimizer, state, values)
+    return model
+
+
+def build(header):
+    """Compiled Model with the architecture of a checkpoint header (freshly initialized parameters)"""
+    from models import Model
+
+    model = Model(cache_activations=header['cache_activations'], dtype=header['dtype'], layout=header.get('layout', 'NCHW'), segments=header.get('segments'))
+    for spec in header['layers']:
+        model.add(getattr(layers_module, spec['class'])(**spec['config']))
+    optimizer = from_spec(optimizers_module, header['optimizer'])
+    model.compile(optimizer, from_spec(loss_module, header['loss']), from_spec(loss_module, header['regularization']), clip=header['clip'])
+    return model
+
+
+def replica(model):
+    """Compiled copy of model with its own parameter buffer holding the current parameters (no optimizer state)
+
+    Refresh it later with np.copyto(replica.flat_params, model.flat_params).
+    """
+    # initializing the throwaway parameters must not shift the global random stream training samples from
+    state = np.random.get_state()
+    try:
+        copy = build(snapshot_header(model))
+    finally:
+        np.random.set_state(state)
+    np.copyto(copy.flat_params, model.flat_params)
+    return copy
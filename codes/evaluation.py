@@ -0,0 +1,161 @@
+"""
+Streaming evaluation.
+
+Batches from any iterator of (x, y) pairs go through the inference engine
+(Model.predict: no stored layer inputs, no layer caches, no backward
+bookkeeping), and only running counters are kept: the summed loss, the
+number of samples, a confusion matrix and top-k hits. The loss of every
+batch is weighted by its size, so a ragged last batch counts for what it holds.
+
+BackgroundEvaluator runs the same loop in a thread on a replica of the
+model holding a copy of the parameters, so periodic evaluation stalls
+training only for that copy.
+"""
+
+import threading
+import numpy as np
+import checkpoint
+
+
+class RunningMetrics():
+
+    def __init__(self, num_class=None, top_k=(5,)):
+        """Initialization
+
+        # Arguments
+            num_class: int, the number of categories (None to take it from the first batch)
+            top_k: tuple of int, the k of every top-k accuracy to track
+        """
+        self.num_class = num_class
+        self.top_k = tuple(top_k)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum_loss = 0.
+        self.confusion = None if self.num_class is None else np.zeros((self.num_class, self.num_class), dtype=np.int64)
+        self.top_k_hits = dict((k, 0) for k in self.top_k)
+
+    def update(self, logits, targets, loss):
+        """Add one batch
+
+        # Arguments
+            logits: numpy array with shape (batch, num_class), scores or probabilities
+            targets: numpy array with shape (batch,)
+            loss: float, mean loss of the batch
+        """
+        N, num_class = logits.shape
+        if self.confusion is None:
+            self.num_class = num_class
+            self.confusion = np.zeros((num_class, num_class), dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        self.count += N
+        self.sum_loss += float(loss) * N
+        # rows are targets, columns predictions
+        predictions = np.argmax(logits, axis=1)
+        self.confusion += np.bincount(targets * num_class + predictions, minlength=num_class * num_class).reshape(num_class, num_class)
+        for k in self.top_k:
+            if k >= num_class:
+                self.top_k_hits[k] += N
+            else:
+                top = np.argpartition(logits, -k, axis=1)[:, -k:]
+                self.top_k_hits[k] += int(np.sum(top == targets[:, None]))
+
+    @property
+    def loss(self):
+        return self.sum_loss / max(self.count, 1)
+
+    @property
+    def accuracy(self):
+        if self.confusion is None:
+            return 0.
+        return np.trace(self.confusion) / max(self.count, 1)
+
+    def top_k_accuracy(self, k):
+        return self.top_k_hits[k] / max(self.count, 1)
+
+    def result(self):
+        """Dictionary of the metrics so far: loss, accuracy, top-k accuracies and the confusion matrix"""
+        result = {'count': self.count, 'loss': self.loss, 'accuracy': self.accuracy, 'confusion': self.confusion}
+        for k in self.top_k:
+            result['top%d' % k] = self.top_k_accuracy(k)
+        return result
+
+
+def evaluate(model, batches, top_k=(5,), metrics=None):
+    """Inference-only pass of model over batches
+
+    # Arguments
+        model: Model, compiled; its loss layer scores the logits
+        batches: iterable of (x, y), e.g. MNIST.test_loader(batch)
+        metrics: RunningMetrics to add to (None for a new one)
+
+    # Returns
+        metrics: RunningMetrics
+    """
+    if metrics is None:
+        metrics = RunningMetrics(top_k=top_k)
+    loss_layer = model.layers[-1]
+    # in testing mode no layer (nor the loss) keeps anything for a backward pass
+    modes = [layer.training for layer in model.layers]
+    for layer in model.layers:
+        layer.set_mode(training=False)
+    try:
+        for x, y in batches:
+            logits = model.predict(x)
+            loss, _ = loss_layer.forward(logits, y)
+            metrics.update(logits, y, loss)
+    finally:
+        for layer, training in zip(model.layers, modes):
+            layer.set_mode(training=training)
+    return metrics
+
+
+class BackgroundEvaluator():
+
+    def __init__(self, model, top_k=(5,)):
+        """Initialization
+
+        # Arguments
+            model: Model, compiled model being trained
+            top_k: tuple of int, passed to RunningMetrics
+        """
+        self.model = model
+        self.top_k = top_k
+        self.replica = checkpoint.replica(model)
+        self.thread = None
+        self.error = None
+        self.results = [] # (tag, name, RunningMetrics) in completion order
+
+    def submit(self, tag, jobs):
+        """Evaluate the current parameters in the background
+
+        Waits for the previous evaluation, copies the parameters into the replica
+        and returns; training can go on updating the model right away.
+
+        # Arguments
+            tag: anything identifying the snapshot, e.g. the iteration
+            jobs: list of (name, batches), all evaluated on the same snapshot
+        """
+        self.wait()
+        np.copyto(self.replica.flat_params, self.model.flat_params)
+        self.thread = threading.Thread(target=self.run, args=(tag, jobs), daemon=True)
+        self.thread.start()
+
+    def run(self, tag, jobs):
+        try:
+            for name, batches in jobs:
+                metrics = evaluate(self.replica, batches, self.top_k)
+                self.results.append((tag, name, metrics))
+                print('[%s] %s accuracy=%.5f, loss=%.5f' % (tag, name, metrics.accuracy, metrics.loss))
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """Block until the running evaluation is done, re-raising its error if it failed"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
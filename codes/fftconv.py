@@ -0,0 +1,145 @@
+"""
+FFT convolution for Convolution layers with large kernels.
+
+Instead of materializing C*kh*kw x N*H_out*W_out columns, the padded inputs,
+kernels and output gradients are transformed with numpy.fft.rfft2 at the
+padded input size (Hp, Wp). All three passes are products in the frequency
+domain, summed over channels with one batched matmul per frequency:
+
+    forward:       Y[n, k]  = sum_c X[n, c] * conj(W[k, c])     (correlation)
+    weight grads:  dW[k, c] = sum_n X[n, c] * conj(dY[n, k])
+    input grads:   dX[n, c] = sum_k dY[n, k] * W[k, c]          (convolution)
+
+At size (Hp, Wp) the circular wrap-around never reaches the entries that
+are kept, so the results equal the linear ones. Strides are handled by
+computing the stride-1 output and subsampling it (forward), or by spreading
+the output gradients over a zero grid (backward). Memory grows with
+N*C*Hp*Wp, whatever the kernel size.
+"""
+
+import numpy as np
+
+
+def transform_size(in_height, in_width, pad):
+    """The FFT size (Hp, Wp) used for inputs of this size"""
+    return in_height + 2 * pad, in_width + 2 * pad
+
+
+def kernel_transform(weights, size):
+    """rfft2 of the kernels at the FFT size, laid out (freq, in_channel, out_channel) for the matmuls
+
+    # Arguments
+        weights: numpy array with shape (out_channel, in_channel, kernel_h, kernel_w)
+        size: tuple (Hp, Wp), see transform_size
+
+    # Returns
+        Wf: complex numpy array with shape (Hp*(Wp//2+1), in_channel, out_channel)
+    """
+    K, C = weights.shape[:2]
+    Wf = np.fft.rfft2(weights, s=size)
+    return np.ascontiguousarray(Wf.reshape(K, C, -1).transpose(2, 1, 0))
+
+
+def to_freq(x, size):
+    """rfft2 of (batch, channel, h, w) arrays, laid out (freq, batch, channel)"""
+    N, C = x.shape[:2]
+    return np.fft.rfft2(x, s=size).reshape(N, C, -1).transpose(2, 0, 1)
+
+
+def from_freq(xf, size):
+    """Inverse of to_freq"""
+    F, N, C = xf.shape
+    return np.fft.irfft2(xf.transpose(1, 2, 0).reshape(N, C, size[0], size[1] // 2 + 1), s=size)
+
+
+def pad_inputs(inputs, pad):
+    if pad == 0:
+        return inputs
+    return np.pad(inputs, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+
+
+def conv2d(inputs, weights, bias=None, pad=0, stride=1, Wf=None):
+    """Convolution forward pass, same result as the im2col path of layers.Convolution
+
+    # Arguments
+        inputs: numpy array with shape (batch, in_channel, in_height, in_width)
+        weights: numpy array with shape (out_channel, in_channel, kernel_h, kernel_w)
+        bias: numpy array with shape (out_channel,) or None
+        Wf: kernel_transform(weights, size) if already computed
+
+    # Returns
+        outputs: numpy array with shape (batch, out_channel, out_height, out_width)
+    """
+    kh, kw = weights.shape[2:]
+    size = transform_size(inputs.shape[2], inputs.shape[3], pad)
+    if Wf is None:
+        Wf = kernel_transform(weights, size)
+    Xf = to_freq(pad_inputs(inputs, pad), size)
+    Yf = np.matmul(Xf, Wf.conj())
+    outputs = from_freq(Yf, size)[:, :, :size[0]-kh+1:stride, :size[1]-kw+1:stride]
+    outputs = outputs.astype(np.result_type(inputs, weights), copy=False)
+    if bias is not None:
+        outputs += bias.reshape(1, -1, 1, 1)
+    return outputs
+
+
+def spread(in_grads, size, kh, kw, stride):
+    """Output gradients placed on the stride-1 output grid, zero-padded to the FFT size"""
+    if stride == 1:
+        return in_grads
+    N, K, h_out, w_out = in_grads.shape
+    spread = np.zeros((N, K, size[0] - kh + 1, size[1] - kw + 1), dtype=in_grads.dtype)
+    spread[:, :, ::stride, ::stride][:, :, :h_out, :w_out] = in_grads
+    return spread
+
+
+def conv2d_backward(in_grads, inputs, weights, pad=0, stride=1, Wf=None, w_grad=None):
+    """Gradients to the weights and the inputs of conv2d(inputs, weights, pad=pad, stride=stride)
+
+    # Arguments
+        in_grads: numpy array with shape (batch, out_channel, out_height, out_width)
+        inputs: numpy array with shape (batch, in_channel, in_height, in_width)
+        w_grad: numpy array the gradients to the weights are written into (None for a new one)
+
+    # Returns
+        w_grad: numpy array with shape (out_channel, in_channel, kernel_h, kernel_w)
+        out_grads: numpy array with shape (batch, in_channel, in_height, in_width)
+    """
+    N, C, H, W = inputs.shape
+    kh, kw = weights.shape[2:]
+    size = transform_size(H, W, pad)
+    if Wf is None:
+        Wf = kernel_transform(weights, size)
+    Xf = to_freq(pad_inputs(inputs, pad), size)
+    DYf = to_freq(spread(in_grads, size, kh, kw, stride), size)
+
+    # (freq, out_channel, batch) x (freq, batch, in_channel)
+    dWf = np.matmul(DYf.conj().transpose(0, 2, 1), Xf)
+    dW = from_freq(dWf, size)[:, :, :kh, :kw]
+    if w_grad is None:
+        w_grad = np.empty(weights.shape, dtype=np.result_type(inputs, weights))
+    np.copyto(w_grad, dW, casting='unsafe')
+
+    # (freq, batch, out_channel) x (freq, out_channel, in_channel)
+    dXf = np.matmul(DYf, Wf.transpose(0, 2, 1))
+    out_grads = from_freq(dXf, size)[:, :, pad:pad+H, pad:pad+W]
+    return w_grad, out_grads.astype(in_grads.dtype, copy=False)
+
+
+def preferred(in_height, in_width, in_channel, out_channel, kernel_h, kernel_w, pad, stride):
+    """Whether FFT is expected to beat im2col+GEMM for this geometry
+
+    Per sample, im2col+GEMM costs H_out*W_out*kh*kw*C*K multiply-adds. The FFT
+    path costs Hp*Wp*(2*C*K + (C+K)*log2(Hp*Wp)): the complex products plus the
+    transforms of the inputs and output gradients. On the shapes of
+    benchmarks/bench_fftconv.py FFT wins once the first is about 4 times the
+    second, e.g. 5x5 and larger kernels with 16 channels on 32x32 images, but
+    only 11x11 kernels with a single input channel on 28x28. 3x3 kernels never
+    get there.
+    """
+    h_out = (in_height + 2 * pad - kernel_h) // stride + 1
+    w_out = (in_width + 2 * pad - kernel_w) // stride + 1
+    Hp, Wp = transform_size(in_height, in_width, pad)
+    direct = h_out * w_out * kernel_h * kernel_w * in_channel * out_channel
+    fft = Hp * Wp * (2 * in_channel * out_channel + (in_channel + out_channel) * np.log2(Hp * Wp))
+    return direct > 4 * fft
@@ -1,7 +1,63 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 
-def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+class IndexCache(object):
+  """ An LRU cache of im2col index plans, keyed by input shape and conv geometry """
+
+  def __init__(self, maxsize=32):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self._plans = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, build):
+    with self._lock:
+      plan = self._plans.get(key)
+      if plan is not None:
+        self.hits += 1
+        self._plans.move_to_end(key)
+        return plan
+      self.misses += 1
+    plan = build()
+    # the plan is shared by every caller, so nobody may write into it
+    for a in plan:
+      a.setflags(write=False)
+    with self._lock:
+      self._plans[key] = plan
+      if len(self._plans) > self.maxsize:
+        self._plans.popitem(last=False)
+    return plan
+
+  def info(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses,
+              'size': len(self._plans), 'maxsize': self.maxsize}
+
+  def clear(self):
+    with self._lock:
+      self._plans.clear()
+      self.hits = 0
+      self.misses = 0
+
+
+_index_cache = IndexCache()
+
+
+def index_cache_info():
+  """ Hit/miss counters of the shared im2col index cache """
+  return _index_cache.info()
+
+
+def clear_index_cache():
+  _index_cache.clear()
+
+
+def _build_im2col_indices(x_shape, field_height, field_width, padding, stride):
   # First figure out what the size of the output should be
   N, C, H, W = x_shape
   out_height = int((H + 2 * padding - field_height) // stride + 1)
@@ -20,19 +76,89 @@ def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
   return (k, i, j)
 
 
-def im2col_indices(x, field_height, field_width, padding=1, stride=1):
-  """ An implementation of im2col based on some fancy indexing """
-  # Zero-pad the input
+def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+  """ Index plan (k, i, j) for im2col, served from the shared LRU cache """
+  key = (tuple(x_shape), field_height, field_width, padding, stride)
+  return _index_cache.get(key, lambda: _build_im2col_indices(
+      x_shape, field_height, field_width, padding, stride))
+
+
+def _build_im2col_rows(x_shape, field_height, field_width, padding, stride):
+  # flat offsets of every (channel, row, column) of the columns into a padded
+  # (C, H, W) image, in the row-major order of im2col
+  k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding, stride)
+  H = x_shape[2] + 2 * padding
+  W = x_shape[3] + 2 * padding
+  return ((k * H + i) * W + j).ravel(),
+
+
+def get_im2col_rows(x_shape, field_height, field_width, padding=1, stride=1):
+  """ Flat index plan for im2col_indices, served from the shared LRU cache """
+  key = ('rows', tuple(x_shape[1:]), field_height, field_width, padding, stride)
+  return _index_cache.get(key, lambda: _build_im2col_rows(
+      x_shape, field_height, field_width, padding, stride))[0]
+
+
+def im2col_indices(x, field_height, field_width, padding=1, stride=1, out=None):
+  """ An implementation of im2col based on some fancy indexing
+
+  The input is zero-padded into (C, H, W, N) order, so every index picks a
+  contiguous row of N samples and np.take gathers straight into the columns.
+  """
+  N, C, H, W = x.shape
   p = padding
-  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+  x_padded = np.zeros((C, H + 2 * p, W + 2 * p, N), dtype=x.dtype)
+  x_padded[:, p:p + H, p:p + W, :] = x.transpose(1, 2, 3, 0)
 
-  k, i, j = get_im2col_indices(x.shape, field_height, field_width, padding,
-                               stride)
+  rows = get_im2col_rows(x.shape, field_height, field_width, padding, stride)
+  if out is None:
+    K = field_height * field_width * C
+    out = np.empty((K, rows.size // K * N), dtype=x.dtype)
+  # mode='clip' lets np.take write into out directly instead of through a buffer
+  np.take(x_padded.reshape(-1, N), rows, axis=0, out=out.reshape(rows.size, N), mode='clip')
+  return out
 
-  cols = x_padded[:, k, i, j]
+def im2col_strided(x, field_height, field_width, padding=1, stride=1, out=None):
+  """ An implementation of im2col on a zero-copy sliding window view """
+  p = padding
+  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant') if p else x
+
+  # (N, C, out_height, out_width, field_height, field_width), no data is moved
+  windows = sliding_window_view(x_padded, (field_height, field_width), axis=(2, 3))
+  windows = windows[:, :, ::stride, ::stride]
+
+  # the only copy: lay the windows out in the same order as im2col_indices
   C = x.shape[1]
-  cols = cols.transpose(1, 2, 0).reshape(field_height * field_width * C, -1)
-  return cols
+  windows = windows.transpose(1, 4, 5, 2, 3, 0)
+  if out is not None:
+    out.reshape(windows.shape)[...] = windows
+    return out
+  return windows.reshape(field_height * field_width * C, -1)
+
+
+_im2col_engines = {
+  'indices': im2col_indices,
+  'strided': im2col_strided,
+}
+_default_engine = 'indices'
+
+
+def set_im2col_engine(engine):
+  """ Select the im2col engine used by layers that do not choose their own """
+  global _default_engine
+  if engine not in _im2col_engines:
+    raise ValueError('Unknown im2col engine: %s' % engine)
+  _default_engine = engine
+
+
+def im2col(x, field_height, field_width, padding=1, stride=1, engine=None, out=None):
+  """ Dispatch to the chosen im2col engine (the global default if None)
+
+  If out is given the columns are written into it instead of a new array.
+  """
+  return _im2col_engines[engine or _default_engine](x, field_height, field_width,
+                                                    padding, stride, out)
+
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
                    stride=1):
@@ -46,4 +172,66 @@ def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
   np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
   if padding == 0:
       return x_padded
-  return x_padded[:, :, padding:-padding, padding:-padding]
\ No newline at end of file
+  return x_padded[:, :, padding:-padding, padding:-padding]
+
+def _col2im_padded(cols, C, H, W, N, field_height, field_width, padding, stride):
+  """ Accumulate columns into a zero-padded (C, H, W, N) array, one strided add per kernel offset """
+  H_padded, W_padded = H + 2 * padding, W + 2 * padding
+  out_height = (H_padded - field_height) // stride + 1
+  out_width = (W_padded - field_width) // stride + 1
+
+  # accumulate in (C, H, W, N), the native order of the columns, so every add
+  # is a large vectorized op over contiguous runs of the batch axis
+  cols_reshaped = cols.reshape(C, field_height, field_width, out_height, out_width, N)
+  x_padded = np.zeros((C, H_padded, W_padded, N), dtype=cols.dtype)
+  for di in range(field_height):
+    i_end = di + stride * out_height
+    for dj in range(field_width):
+      j_end = dj + stride * out_width
+      x_padded[:, di:i_end:stride, dj:j_end:stride] += cols_reshaped[:, di, dj]
+  return x_padded[:, padding:H_padded - padding, padding:W_padded - padding]
+
+def col2im_slices(cols, x_shape, field_height=3, field_width=3, padding=1,
+                  stride=1, out=None):
+  """ An implementation of col2im that adds one strided slice per kernel offset """
+  N, C, H, W = x_shape
+  x = _col2im_padded(cols, C, H, W, N, field_height, field_width, padding, stride)
+  if out is not None:
+    out[...] = x.transpose(3, 0, 1, 2)
+    return out
+  return np.ascontiguousarray(x.transpose(3, 0, 1, 2))
+
+def im2col_chwn(x, field_height, field_width, padding=1, stride=1, out=None):
+  """ im2col of (C, H, W, N) inputs, with the columns in the same order as im2col's
+
+  The GEMM output of these columns is already (out_channel, H_out, W_out, N),
+  so channels-last-batch models need no transposes between layers.
+  """
+  p = padding
+  x_padded = np.pad(x, ((0, 0), (p, p), (p, p), (0, 0)), mode='constant') if p else x
+
+  # (C, out_height, out_width, N, field_height, field_width), no data is moved
+  windows = sliding_window_view(x_padded, (field_height, field_width), axis=(1, 2))
+  windows = windows[:, ::stride, ::stride]
+  windows = windows.transpose(0, 4, 5, 1, 2, 3)
+  if out is not None:
+    out.reshape(windows.shape)[...] = windows
+    return out
+  return windows.reshape(field_height * field_width * x.shape[0], -1)
+
+def col2im_chwn(cols, x_shape, field_height=3, field_width=3, padding=1,
+                stride=1, out=None):
+  """ col2im back to (C, H, W, N), the inverse layout of im2col_chwn """
+  C, H, W, N = x_shape
+  x = _col2im_padded(cols, C, H, W, N, field_height, field_width, padding, stride)
+  if out is not None:
+    out[...] = x
+    return out
+  return np.ascontiguousarray(x)
+
+
+def col2im(cols, x_shape, field_height=3, field_width=3, padding=1, stride=1,
+           out=None):
+  """ col2im used by the layers; col2im_indices is kept as the reference path """
+  return col2im_slices(cols, x_shape, field_height, field_width, padding, stride,
+                       out)
@@ -0,0 +1,181 @@
+"""
+Inference-only forward passes.
+
+The engine keeps no activations for a backward pass, never touches the
+layers' caches and needs no targets. Convolution -> ReLU -> Pooling chains
+are fused into one kernel: the im2col GEMM writes its output in
+(channel, height, width, batch) layout, bias and ReLU are applied in place on
+that output, and pooling reduces over it directly. Consecutive blocks stay in
+that layout, so no transposes are needed until Flatten. Intermediate arrays
+live in buffers that are reused for every batch of the same shape.
+"""
+
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from layers import Convolution, ReLU, Pooling, Dropout, Flatten, FCLayer
+from loss import Loss
+
+
+def softmax(logits):
+    exps = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return exps / np.sum(exps, axis=1, keepdims=True)
+
+
+class InferenceEngine():
+
+    def __init__(self, model):
+        """Initialization
+
+        # Arguments
+            model: Model, the layers are read on every call, so later parameter updates are picked up
+        """
+        self.model = model
+        self.stages = self.plan([layer for layer in model.layers if not isinstance(layer, Loss)])
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def plan(self, layers):
+        """Group the layers into stages, fusing Convolution/FCLayer with a following ReLU (and Pooling)"""
+        stages = []
+        l = 0
+        while l < len(layers):
+            layer = layers[l]
+            relu = l + 1 < len(layers) and isinstance(layers[l+1], ReLU)
+            if isinstance(layer, Convolution):
+                pool = None
+                if relu and l + 2 < len(layers) and isinstance(layers[l+2], Pooling):
+                    pool = layers[l+2]
+                stages.append(('conv', layer, relu, pool))
+                l += 1 + relu + (pool is not None)
+            elif isinstance(layer, FCLayer):
+                stages.append(('fc', layer, relu, None))
+                l += 1 + relu
+            elif isinstance(layer, ReLU):
+                stages.append(('relu', layer, False, None))
+                l += 1
+            elif isinstance(layer, Pooling):
+                stages.append(('pool', layer, False, None))
+                l += 1
+            elif isinstance(layer, Flatten):
+                stages.append(('flatten', layer, False, None))
+                l += 1
+            elif isinstance(layer, Dropout):
+                # identity at inference time
+                l += 1
+            else:
+                stages.append(('layer', layer, False, None))
+                l += 1
+        return stages
+
+    def buffer(self, key, shape, dtype, zeros=False):
+        """Contiguous array of shape carved from one flat allocation per key
+
+        The allocation grows to the largest size seen, so every batch size (e.g. the
+        micro-batches of a BatchingServer) shares it. Zero-filled ones keep their zero
+        border across calls as long as the shape stays the same.
+        """
+        size = int(np.prod(shape))
+        flat, last_shape = self.buffers.get(key, (None, None))
+        if flat is None or flat.size < size or flat.dtype != dtype:
+            flat = np.empty(size, dtype=dtype)
+            last_shape = None
+        buffer = flat[:size].reshape(shape)
+        if zeros and last_shape != shape:
+            buffer.fill(0)
+        self.buffers[key] = (flat, shape)
+        return buffer
+
+    def clear(self):
+        """Release all preallocated buffers"""
+        self.buffers = {}
+
+    def predict(self, inputs, probs=False):
+        """Forward pass without training bookkeeping
+
+        # Arguments
+            inputs: numpy array with shape (batch, ...)
+            probs: bool, return softmax probabilities instead of logits
+
+        # Returns
+            outputs: numpy array with shape (batch, num_class), a new array owned by the caller
+        """
+        with self.lock:
+            x = np.asarray(inputs, dtype=self.model.dtype)
+            # spatial activations are kept as (channel, height, width, batch)
+            chwn = False
+            for index, (kind, layer, relu, pool) in enumerate(self.stages):
+                if kind in ('conv', 'pool') and not chwn:
+                    x = x.transpose(1, 2, 3, 0)
+                    chwn = True
+                if kind == 'conv':
+                    x = self.conv(index, layer, x, relu)
+                    if pool is not None:
+                        x = self.pool(index, pool, x)
+                elif kind == 'pool':
+                    x = self.pool(index, layer, x)
+                elif kind == 'fc':
+                    x = self.fc(index, layer, x, relu)
+                elif kind == 'relu':
+                    x = np.maximum(x, 0, out=self.buffer((index, 'relu'), x.shape, x.dtype))
+                elif kind == 'flatten':
+                    x = self.flatten(index, x, chwn)
+                    chwn = False
+                else:
+                    if chwn:
+                        x = x.transpose(3, 0, 1, 2)
+                        chwn = False
+                    x = layer.forward(x)
+            if chwn:
+                x = x.transpose(3, 0, 1, 2)
+            return softmax(x) if probs else np.array(x)
+
+    def pad(self, key, x, pad):
+        if not pad:
+            return x
+        C, H, W, N = x.shape
+        padded = self.buffer(key, (C, H + 2 * pad, W + 2 * pad, N), x.dtype, zeros=True)
+        padded[:, pad:pad+H, pad:pad+W] = x
+        return padded
+
+    def conv(self, index, conv, x, relu):
+        C = x.shape[0]
+        x = self.pad((index, 'conv_pad'), x, conv.pad)
+        windows = sliding_window_view(x, (conv.kernel_h, conv.kernel_w), axis=(1, 2))[:, ::conv.stride, ::conv.stride]
+        _, h_out, w_out, N, _, _ = windows.shape
+
+        # rows (c, kh, kw) and columns (h, w, n), the same order im2col produces
+        cols = self.buffer((index, 'cols'), (C, conv.kernel_h, conv.kernel_w, h_out, w_out, N), x.dtype)
+        np.copyto(cols, windows.transpose(0, 4, 5, 1, 2, 3))
+        out = self.buffer((index, 'out'), (conv.out_channel, h_out * w_out * N), x.dtype)
+        np.matmul(conv.weights.reshape(conv.out_channel, -1), cols.reshape(-1, h_out * w_out * N), out=out)
+        out += conv.bias.reshape(-1, 1)
+        if relu:
+            np.maximum(out, 0, out=out)
+        return out.reshape(conv.out_channel, h_out, w_out, N)
+
+    def pool(self, index, pool, x):
+        x = self.pad((index, 'pool_pad'), x, pool.pad)
+        windows = sliding_window_view(x, (pool.pool_height, pool.pool_width), axis=(1, 2))[:, ::pool.stride, ::pool.stride]
+        out = self.buffer((index, 'pool'), windows.shape[:4], x.dtype)
+        if pool.pool_type == 'max':
+            np.max(windows, axis=(4, 5), out=out)
+        else:
+            np.mean(windows, axis=(4, 5), out=out)
+        return out
+
+    def fc(self, index, fc, x, relu):
+        out = self.buffer((index, 'fc'), (x.shape[0], fc.weights.shape[1]), x.dtype)
+        np.matmul(x, fc.weights, out=out)
+        out += fc.bias
+        if relu:
+            np.maximum(out, 0, out=out)
+        return out
+
+    def flatten(self, index, x, chwn):
+        if not chwn:
+            return x.reshape(x.shape[0], -1)
+        C, H, W, N = x.shape
+        out = self.buffer((index, 'flatten'), (N, C * H * W), x.dtype)
+        np.copyto(out.reshape(N, C, H, W), x.transpose(3, 0, 1, 2))
+        return out
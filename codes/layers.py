@@ -6,6 +6,10 @@ change log:
 import numpy as np 
 from utils.tools import *
 from im2col import *
+from parallel import batch_shards, batch_chunks, map_shards
+import winograd
+import fftconv
+import pooling
 
 class Layer(object):
     """
@@ -16,6 +20,11 @@ class Layer(object):
         self.name = name
         self.training = True  # The phrase, if for training then true
         self.trainable = False # Whether there are parameters in this layer that can be trained
+        self.keep_cache = False # Whether to keep forward-pass intermediates for the backward pass
+        self.cache = None
+        self.buffers = {} # Scratch arrays reused across steps
+        self.layout = 'NCHW' # Axis order of 4-D activations, 'NCHW' or 'CHWN'
+        self.independent_samples = True # Whether the outputs of a sample depend on that sample only
 
     def forward(self, inputs):
         """Forward pass, reture outputs"""
@@ -41,6 +50,67 @@ class Layer(object):
         """Reture parameters and gradients of this layer"""
         return None
 
+    def get_config(self):
+        """Return the keyword arguments that rebuild this layer (without its parameters)"""
+        return {'name': self.name}
+
+    def set_dtype(self, dtype):
+        """Cast parameters, gradients and any other state of this layer into dtype"""
+        pass
+
+    def set_cache(self, keep_cache):
+        """Keep (True) or drop (False) forward-pass intermediates for the backward pass"""
+        self.keep_cache = keep_cache
+        if not keep_cache:
+            self.cache = None
+
+    def clear_cache(self):
+        """Release the intermediates kept by the last forward pass"""
+        self.cache = None
+
+    def get_cache(self, inputs):
+        """What the last forward pass kept, if that pass ran on inputs (None otherwise)"""
+        if self.cache is not None and self.cache[0] is inputs:
+            return self.cache[1]
+        return None
+
+    def set_layout(self, layout):
+        """Lay out 4-D activations as 'NCHW' (batch, channel, height, width) or 'CHWN' (channel, height, width, batch)"""
+        if layout not in ('NCHW', 'CHWN'):
+            raise ValueError('Unknown layout: %s' % layout)
+        self.layout = layout
+
+    def set_shard(self, start, batch):
+        """Take the inputs of the next passes as samples start.. of a batch of size batch split across processes (None for whole batches)"""
+        pass
+
+    def skip_step(self):
+        """Account for a training step that ran on replicas of this layer (DataParallel workers)"""
+        pass
+
+    def nchw_shape(self, inputs):
+        """The (batch, channel, height, width) sizes of 4-D inputs in self.layout"""
+        if self.layout == 'CHWN':
+            C, H, W, N = inputs.shape
+            return N, C, H, W
+        return inputs.shape
+
+    def batch(self, x, index):
+        """Index x along the batch axis of self.layout"""
+        return x[..., index] if self.layout == 'CHWN' else x[index]
+
+    def get_buffer(self, key, shape, dtype):
+        """Return the scratch array stored under key, reallocated only when shape or dtype change"""
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[key] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def get_scratch(self, key, shape, dtype, capacity=0):
+        """Return a contiguous array of shape carved from a flat buffer of at least capacity elements, so chunks of different sizes share one allocation"""
+        size = int(np.prod(shape))
+        return self.get_buffer(key, (max(size, capacity),), dtype)[:size].reshape(shape)
+
 
 class FCLayer(Layer):
     def __init__(self, in_features, out_features, name='fclayer', initializer=Guassian()):
@@ -89,8 +159,8 @@ class FCLayer(Layer):
         out_grads = None
         #############################################################
         # code here
-        self.w_grad = inputs.T @ in_grads
-        self.b_grad = np.sum(in_grads, axis=0)
+        np.matmul(inputs.T, in_grads, out=self.w_grad)
+        np.sum(in_grads, axis=0, out=self.b_grad)
         out_grads = in_grads @ self.weights.T
         #############################################################
         return out_grads
@@ -104,11 +174,12 @@ class FCLayer(Layer):
         # Returns
             none
         """
+        # copy into the existing arrays, other code may hold references to them
         for k,v in params.items():
             if 'weights' in k:
-                self.weights = v
+                np.copyto(self.weights, v)
             else:
-                self.bias = v
+                np.copyto(self.bias, v)
         
     def get_params(self, prefix):
         """Return parameters (self.weights and self.bias) as well as gradients (self.w_grad and self.b_grad)
@@ -135,6 +206,16 @@ class FCLayer(Layer):
         else:
             return None
 
+    def set_dtype(self, dtype):
+        """Cast parameters (self.weights and self.bias) and gradients (self.w_grad and self.b_grad) into dtype"""
+        self.weights = self.weights.astype(dtype, copy=False)
+        self.bias = self.bias.astype(dtype, copy=False)
+        self.w_grad = self.w_grad.astype(dtype, copy=False)
+        self.b_grad = self.b_grad.astype(dtype, copy=False)
+
+    def get_config(self):
+        return {'in_features': self.weights.shape[0], 'out_features': self.weights.shape[1], 'name': self.name}
+
 class Convolution(Layer):
     def __init__(self, conv_params, initializer=Guassian(), name='conv'):
         """Initialization
@@ -147,16 +228,28 @@ class Convolution(Layer):
                 'pad': The number of pixels padded to the bottom, top, left and right of each feature map. Here, pad=2 means a 2-pixel border of padded with zeros.
                 'in_channel': The number of input channels.
                 'out_channel': The number of output channels.
+                'im2col': (optional) The im2col engine, 'indices' or 'strided'. None follows the global default.
+                'threads': (optional) The number of threads the batch is sharded across (default 1).
+                'memory_budget': (optional) Bytes the im2col columns may take. The batch is processed in chunks that fit, reusing one buffer, None (default) for the whole batch at once.
+                'backend': (optional) 'auto' (default), 'im2col', 'winograd' or 'fft'. Winograd F(2x2,3x3) computes the forward pass and the gradients to inputs of 3x3 stride-1 convolutions with pad <= 2, other geometries fall back to im2col. 'fft' computes every pass with rfft2 and suits large kernels. 'auto' picks fft or im2col from the geometry (see fftconv.preferred).
             initializer: Initializer class, to initialize weights
         """
         super(Convolution, self).__init__(name=name)
         self.trainable = True
+        self.conv_params = dict(conv_params)
         self.kernel_h = conv_params['kernel_h'] # height of kernel
         self.kernel_w = conv_params['kernel_w'] # width of kernel
         self.pad = conv_params['pad']
         self.stride = conv_params['stride']
         self.in_channel = conv_params['in_channel']
         self.out_channel = conv_params['out_channel']
+        self.im2col_engine = conv_params.get('im2col', None)
+        self.threads = conv_params.get('threads', 1)
+        self.memory_budget = conv_params.get('memory_budget', None)
+        self.backend = conv_params.get('backend', 'auto')
+        if self.backend not in ('auto', 'im2col', 'winograd', 'fft'):
+            raise ValueError('Unknown convolution backend: %s' % self.backend)
+        self.kernel_cache = None # (fft size, weights, kernel transform) of the last FFT pass
 
         self.weights = initializer.initialize((self.out_channel, self.in_channel, self.kernel_h, self.kernel_w))
         self.bias = np.zeros((self.out_channel))
@@ -174,16 +267,113 @@ class Convolution(Layer):
             outputs: numpy array with shape (batch, out_channel, out_height, out_width)
         """
         outputs = None
-        # computing X_col
-        X_col = im2col_indices(inputs, self.kernel_h, self.kernel_w, padding=self.pad, stride=self.stride)
+        chwn = self.layout == 'CHWN'
+        shape = N, C, H, W = self.nchw_shape(inputs)
+        h_out = int((H + 2 * self.pad - self.kernel_h)//self.stride + 1)
+        w_out = int((W + 2 * self.pad - self.kernel_w)//self.stride + 1)
         W_col = self.weights.reshape(self.out_channel, -1)
-        h_out = int((inputs.shape[2] + 2 * self.pad - self.kernel_h)//self.stride + 1)
-        w_out = int((inputs.shape[3] + 2 * self.pad - self.kernel_w)//self.stride + 1)
-        X_col_mult_W_col = (W_col @ X_col) + self.bias.reshape(-1, 1)
-        out =  X_col_mult_W_col.reshape(self.out_channel, h_out, w_out, inputs.shape[0])
-        outputs = out.transpose(3, 0, 1, 2)
+        shards = batch_shards(N, self.threads)
+        backend = self.get_backend(shape)
+        chunks, per_sample = self.get_chunks(inputs, shards, backend)
+        chunked = any(len(shard_chunks) > 1 for shard_chunks in chunks)
+        if len(shards) > 1 or chunked:
+            out_shape = (self.out_channel, h_out, w_out, N) if chwn else (N, self.out_channel, h_out, w_out)
+            outputs = np.empty(out_shape, dtype=np.result_type(inputs, W_col))
+
+        if backend == 'winograd':
+            U = winograd.filter_transform(self.weights)
+        elif backend == 'fft':
+            Wf = self.get_kernel_transform(shape)
+
+        def forward_shard(index, shard):
+            if backend != 'im2col':
+                # these backends work in (batch, channel, height, width)
+                x = self.batch(inputs, shard)
+                if chwn:
+                    x = x.transpose(3, 0, 1, 2)
+                if backend == 'winograd':
+                    out = winograd.conv2d(x, self.weights, self.bias, self.pad, U=U)
+                else:
+                    out = fftconv.conv2d(x, self.weights, self.bias, self.pad, self.stride, Wf=Wf)
+                if chwn:
+                    out = out.transpose(1, 2, 3, 0)
+                if outputs is None:
+                    return None, out
+                self.batch(outputs, shard)[...] = out
+                return None, None
+            # every chunk of the shard reuses the same column buffer
+            capacity = (chunks[index][0].stop - chunks[index][0].start) * per_sample
+            for chunk in chunks[index]:
+                # computing X_col
+                X_col = self.get_columns(self.batch(inputs, chunk), index, outputs is not None, capacity)
+                X_col_mult_W_col = W_col @ X_col
+                X_col_mult_W_col += self.bias.reshape(-1, 1)
+                # the GEMM output is (out_channel, out_height, out_width, batch) already
+                out = X_col_mult_W_col.reshape(self.out_channel, h_out, w_out, -1)
+                if not chwn:
+                    out = out.transpose(3, 0, 1, 2)
+                if outputs is None:
+                    return X_col, out
+                self.batch(outputs, chunk)[...] = out
+            return X_col, None
+
+        results = map_shards(forward_shard, shards, self.threads)
+        # the other backends build no columns, a Winograd backward makes them for the weight gradients;
+        # chunks overwrite each other's columns, so there is nothing to keep either
+        self.cache = None
+        if self.keep_cache and self.training and backend == 'im2col' and not chunked:
+            self.cache = (inputs, [X_col for X_col, _ in results])
+        if outputs is None:
+            outputs = results[0][1]
         return outputs
 
+    def get_backend(self, input_shape):
+        """The backend used for inputs of this shape, resolving 'auto' and unsupported geometries"""
+        if self.backend == 'winograd':
+            return 'winograd' if winograd.supported(self.kernel_h, self.kernel_w, self.stride, self.pad) else 'im2col'
+        if self.backend == 'auto':
+            fft = fftconv.preferred(input_shape[2], input_shape[3], self.in_channel, self.out_channel, self.kernel_h, self.kernel_w, self.pad, self.stride)
+            return 'fft' if fft else 'im2col'
+        return self.backend
+
+    def get_kernel_transform(self, input_shape):
+        """FFT of the kernels for inputs of this shape, reused until the weights or the shape change"""
+        size = fftconv.transform_size(input_shape[2], input_shape[3], self.pad)
+        cached = self.kernel_cache
+        # weights are updated in place, so compare values rather than identity
+        if cached is not None and cached[0] == size and cached[1].dtype == self.weights.dtype and np.array_equal(cached[1], self.weights):
+            return cached[2]
+        Wf = fftconv.kernel_transform(self.weights, size)
+        self.kernel_cache = (size, self.weights.copy(), Wf)
+        return Wf
+
+    def get_chunks(self, inputs, shards, backend):
+        """Split every shard into chunks whose columns fit in the shard's part of self.memory_budget
+
+        # Returns
+            chunks: list, for every shard the list of its chunks (slices of the batch)
+            per_sample: int, the number of column elements of one sample
+        """
+        N, C, H, W = self.nchw_shape(inputs)
+        h_out = (H + 2 * self.pad - self.kernel_h)//self.stride + 1
+        w_out = (W + 2 * self.pad - self.kernel_w)//self.stride + 1
+        per_sample = C * self.kernel_h * self.kernel_w * h_out * w_out
+        # FFT builds no columns
+        budget = None if self.memory_budget is None or backend == 'fft' else self.memory_budget / len(shards)
+        return [batch_chunks(shard, per_sample * inputs.dtype.itemsize, budget) for shard in shards], per_sample
+
+    def get_columns(self, inputs, index=0, buffered=False, capacity=0):
+        """im2col of inputs, written into the buffer of shard index when buffered (sharded or chunked batches)"""
+        out = None
+        N, C, H, W = self.nchw_shape(inputs)
+        if buffered:
+            h_out = (H + 2 * self.pad - self.kernel_h)//self.stride + 1
+            w_out = (W + 2 * self.pad - self.kernel_w)//self.stride + 1
+            out = self.get_scratch(('cols', index), (C * self.kernel_h * self.kernel_w, N * h_out * w_out), inputs.dtype, capacity)
+        if self.layout == 'CHWN':
+            return im2col_chwn(inputs, self.kernel_h, self.kernel_w, padding=self.pad, stride=self.stride, out=out)
+        return im2col(inputs, self.kernel_h, self.kernel_w, padding=self.pad, stride=self.stride, engine=self.im2col_engine, out=out)
+
     def backward(self, in_grads, inputs):
         """Backward pass, store gradients to self.weights into self.w_grad and store gradients to self.bias into self.b_grad
 
@@ -198,19 +388,82 @@ class Convolution(Layer):
         #############################################################
         # code here
         #############################################################
-        out_grads = np.zeros(inputs.shape)
-
-        self.b_grad = np.sum(in_grads, axis=(0, 2, 3))
-
-        inputs_reshaped = in_grads.transpose(1, 2, 3, 0).reshape(self.out_channel, -1)
-        X_col = im2col_indices(inputs, self.kernel_h, self.kernel_w, padding=self.pad, stride=self.stride)
-
-        dW = inputs_reshaped @ X_col.T
-        self.w_grad = dW.reshape(self.weights.shape)
+        chwn = self.layout == 'CHWN'
+        np.sum(in_grads, axis=(1, 2, 3) if chwn else (0, 2, 3), out=self.b_grad)
 
         W_reshape = self.weights.reshape(self.out_channel, -1)
-        dX_col = W_reshape.T @ inputs_reshaped
-        out_grads = col2im_indices(dX_col, inputs.shape, self.kernel_h, self.kernel_w, padding=self.pad, stride=self.stride)
+        w_grad = self.w_grad.reshape(self.out_channel, -1)
+        shape = self.nchw_shape(inputs)
+        shards = batch_shards(shape[0], self.threads)
+        backend = self.get_backend(shape)
+        chunks, per_sample = self.get_chunks(inputs, shards, backend)
+        buffered = len(shards) > 1 or any(len(shard_chunks) > 1 for shard_chunks in chunks)
+        # columns kept by a forward pass over other inputs (or sharded differently) are not used
+        X_cols = self.get_cache(inputs)
+        if X_cols is not None and len(X_cols) != len(shards):
+            X_cols = None
+        if buffered:
+            out_grads = np.empty(inputs.shape, dtype=in_grads.dtype)
+        if backend == 'fft':
+            Wf = self.get_kernel_transform(shape)
+
+        def backward_shard(index, shard):
+            # the first shard writes straight into w_grad, the others into their own partial sums
+            dW = w_grad if index == 0 else self.get_buffer(('w_grad', index), w_grad.shape, w_grad.dtype)
+            if backend == 'fft':
+                x, dY = self.batch(inputs, shard), self.batch(in_grads, shard)
+                if chwn:
+                    x, dY = x.transpose(3, 0, 1, 2), dY.transpose(3, 0, 1, 2)
+                _, dX = fftconv.conv2d_backward(dY, x, self.weights, self.pad, self.stride, Wf=Wf, w_grad=dW.reshape(self.weights.shape))
+                if chwn:
+                    dX = dX.transpose(1, 2, 3, 0)
+                if out_grads is None:
+                    return dX
+                self.batch(out_grads, shard)[...] = dX
+                return None
+
+            capacity = (chunks[index][0].stop - chunks[index][0].start) * per_sample
+            for c, chunk in enumerate(chunks[index]):
+                dY = self.batch(in_grads, chunk)
+                inputs_reshaped = (dY if chwn else dY.transpose(1, 2, 3, 0)).reshape(self.out_channel, -1)
+                if X_cols is not None:
+                    X_col = X_cols[index]
+                else:
+                    X_col = self.get_columns(self.batch(inputs, chunk), index, buffered, capacity)
+                # later chunks add their part of the weight gradients
+                if c == 0:
+                    np.matmul(inputs_reshaped, X_col.T, out=dW)
+                else:
+                    dW += np.matmul(inputs_reshaped, X_col.T, out=self.get_buffer(('w_grad_chunk', index), dW.shape, dW.dtype))
+
+                if backend == 'winograd':
+                    continue
+                if buffered:
+                    dX_col = self.get_scratch(('dcols', index), X_col.shape, np.result_type(W_reshape, inputs_reshaped), capacity)
+                    np.matmul(W_reshape.T, inputs_reshaped, out=dX_col)
+                else:
+                    dX_col = W_reshape.T @ inputs_reshaped
+                chunk_shape = self.batch(inputs, chunk).shape
+                chunk_grads = None if out_grads is None else self.batch(out_grads, chunk)
+                if chwn:
+                    dX = col2im_chwn(dX_col, chunk_shape, self.kernel_h, self.kernel_w, padding=self.pad, stride=self.stride, out=chunk_grads)
+                else:
+                    dX = col2im(dX_col, chunk_shape, self.kernel_h, self.kernel_w, padding=self.pad, stride=self.stride, out=chunk_grads)
+
+            if backend == 'winograd':
+                dY = self.batch(in_grads, shard)
+                dX = winograd.conv2d_input_grads(dY.transpose(3, 0, 1, 2) if chwn else dY, self.weights, self.pad)
+                if chwn:
+                    dX = dX.transpose(1, 2, 3, 0)
+                if out_grads is not None:
+                    self.batch(out_grads, shard)[...] = dX
+            return dX if out_grads is None else None
+
+        results = map_shards(backward_shard, shards, self.threads)
+        for index in range(1, len(shards)):
+            w_grad += self.buffers[('w_grad', index)]
+        if out_grads is None:
+            out_grads = results[0]
 
         return out_grads
 
@@ -223,11 +476,12 @@ class Convolution(Layer):
         # Returns
             none
         """
+        # copy into the existing arrays, other code may hold references to them
         for k,v in params.items():
             if 'weights' in k:
-                self.weights = v
+                np.copyto(self.weights, v)
             else:
-                self.bias = v
+                np.copyto(self.bias, v)
 
     def get_params(self, prefix):
         """Return parameters (self.weights and self.bias) as well as gradients (self.w_grad and self.b_grad)
@@ -254,6 +508,16 @@ class Convolution(Layer):
         else:
             return None
 
+    def set_dtype(self, dtype):
+        """Cast parameters (self.weights and self.bias) and gradients (self.w_grad and self.b_grad) into dtype"""
+        self.weights = self.weights.astype(dtype, copy=False)
+        self.bias = self.bias.astype(dtype, copy=False)
+        self.w_grad = self.w_grad.astype(dtype, copy=False)
+        self.b_grad = self.b_grad.astype(dtype, copy=False)
+
+    def get_config(self):
+        return {'conv_params': dict(self.conv_params), 'name': self.name}
+
 class ReLU(Layer):
     def __init__(self, name='relu'):
         """Initialization
@@ -299,13 +563,33 @@ class Pooling(Layer):
                 'pool_w': The width of pooling kernel.
                 'stride': The number of pixels between adjacent receptive fields in the horizontal and vertical directions.
                 'pad': The number of pixels that will be used to zero-pad the input in each x-y direction. Here, pad=2 means a 2-pixel border of padding with zeros.
+                'im2col': (optional) The im2col engine, 'indices' or 'strided'. None follows the global default.
+                'threads': (optional) The number of threads the batch is sharded across (default 1).
+                'memory_budget': (optional) Bytes the im2col columns may take. The batch is processed in chunks that fit, reusing one buffer, None (default) for the whole batch at once.
+                'backend': (optional) 'auto' (default), 'direct' or 'im2col'. 'direct' pools through strided views of the inputs (see pooling.py) and keeps a one-byte argmax per output; 'auto' uses it whenever a window has at most 256 elements.
         """
         super(Pooling, self).__init__(name=name)
+        self.pool_params = dict(pool_params)
         self.pool_type = pool_params['pool_type']
         self.pool_height = pool_params['pool_height']
         self.pool_width = pool_params['pool_width']
         self.stride = pool_params['stride']
         self.pad = pool_params['pad']
+        self.im2col_engine = pool_params.get('im2col', None)
+        self.threads = pool_params.get('threads', 1)
+        self.memory_budget = pool_params.get('memory_budget', None)
+        self.backend = pool_params.get('backend', 'auto')
+        if self.backend not in ('auto', 'direct', 'im2col'):
+            raise ValueError('Unknown pooling backend: %s' % self.backend)
+
+    def get_backend(self):
+        """The backend actually used, resolving 'auto' and windows too large for the direct kernels"""
+        if self.backend != 'im2col' and pooling.supported(self.pool_height, self.pool_width):
+            return 'direct'
+        return 'im2col'
+
+    def get_config(self):
+        return {'pool_params': dict(self.pool_params), 'name': self.name}
 
     def forward(self, inputs):
         """Forward pass
@@ -319,23 +603,102 @@ class Pooling(Layer):
         outputs = None
         #############################################################
         # code here
-        out_height = int((inputs.shape[2] + 2 * self.pad - self.pool_height)//self.stride + 1)
-        out_width = int((inputs.shape[3] + 2 * self.pad - self.pool_width)//self.stride + 1)
-
-        X_reshaped = inputs.reshape(inputs.shape[0] * inputs.shape[1], 1, inputs.shape[2], inputs.shape[3])
-        X_col = im2col_indices(X_reshaped, self.pool_height, self.pool_width, padding=self.pad, stride=self.stride)
-
-        if(self.pool_type == 'max'):
-            max_idx = np.argmax(X_col, axis=0)
-            outputs = X_col[max_idx, range(max_idx.size)]
-
-        if(self.pool_type == 'avg'):
-            outputs = np.mean(X_col, axis=0)
-
-        outputs = outputs.reshape(out_height, out_width, inputs.shape[0], inputs.shape[1])
-        outputs = outputs.transpose(2, 3, 0, 1)
+        chwn = self.layout == 'CHWN'
+        N, C, H, W = self.nchw_shape(inputs)
+        out_height = int((H + 2 * self.pad - self.pool_height)//self.stride + 1)
+        out_width = int((W + 2 * self.pad - self.pool_width)//self.stride + 1)
+        shards = batch_shards(N, self.threads)
+        backend = self.get_backend()
+        chunks, per_sample = self.get_chunks(inputs, shards, backend)
+        if len(shards) > 1 or any(len(shard_chunks) > 1 for shard_chunks in chunks):
+            out_shape = (C, out_height, out_width, N) if chwn else (N, C, out_height, out_width)
+            outputs = np.empty(out_shape, dtype=inputs.dtype)
+        keep_argmax = self.keep_cache and self.training
+
+        def forward_shard(index, shard):
+            if backend == 'direct':
+                x = self.batch(inputs, shard)
+                max_idx = None
+                if self.pool_type == 'max':
+                    out, max_idx = pooling.max_pool(x, self.pool_height, self.pool_width, self.stride, self.pad, chwn, argmax=keep_argmax)
+                else:
+                    out = pooling.avg_pool(x, self.pool_height, self.pool_width, self.stride, self.pad, chwn)
+                if outputs is None:
+                    return [max_idx], out
+                self.batch(outputs, shard)[...] = out
+                return [max_idx], None
+            # every chunk of the shard reuses the same column buffer
+            capacity = (chunks[index][0].stop - chunks[index][0].start) * per_sample
+            max_idxs = []
+            for chunk in chunks[index]:
+                X_col = self.get_columns(self.batch(inputs, chunk), index, outputs is not None, capacity)
+
+                max_idx = None
+                if chwn:
+                    # (channel, window, out_height*out_width*batch), reduced straight into (C, H, W, N)
+                    X_col = X_col.reshape(C, self.pool_height * self.pool_width, -1)
+                    if(self.pool_type == 'max'):
+                        max_idx = np.argmax(X_col, axis=1)
+                        out = np.take_along_axis(X_col, max_idx[:, None], axis=1)
+                    if(self.pool_type == 'avg'):
+                        out = np.mean(X_col, axis=1)
+                    out = out.reshape(C, out_height, out_width, -1)
+                else:
+                    if(self.pool_type == 'max'):
+                        max_idx = np.argmax(X_col, axis=0)
+                        out = X_col[max_idx, range(max_idx.size)]
+
+                    if(self.pool_type == 'avg'):
+                        out = np.mean(X_col, axis=0)
+
+                    out = out.reshape(out_height, out_width, -1, C)
+                    out = out.transpose(2, 3, 0, 1)
+                max_idxs.append(max_idx)
+                if outputs is None:
+                    return max_idxs, out
+                self.batch(outputs, chunk)[...] = out
+            return max_idxs, None
+
+        results = map_shards(forward_shard, shards, self.threads)
+        # the argmax of every chunk is small next to its columns, keep them all
+        self.cache = None
+        if self.pool_type == 'max' and keep_argmax:
+            self.cache = (inputs, [max_idxs for max_idxs, _ in results])
+        if outputs is None:
+            outputs = results[0][1]
         #############################################################
         return outputs
+
+    def get_chunks(self, inputs, shards, backend):
+        """Split every shard into chunks whose columns fit in the shard's part of self.memory_budget
+
+        # Returns
+            chunks: list, for every shard the list of its chunks (slices of the batch)
+            per_sample: int, the number of column elements of one sample
+        """
+        N, C, H, W = self.nchw_shape(inputs)
+        h_out = (H + 2 * self.pad - self.pool_height)//self.stride + 1
+        w_out = (W + 2 * self.pad - self.pool_width)//self.stride + 1
+        per_sample = self.pool_height * self.pool_width * C * h_out * w_out
+        # the direct kernels build no columns
+        budget = None if self.memory_budget is None or backend == 'direct' else self.memory_budget / len(shards)
+        return [batch_chunks(shard, per_sample * inputs.dtype.itemsize, budget) for shard in shards], per_sample
+
+    def get_columns(self, inputs, index=0, buffered=False, capacity=0):
+        """im2col of every feature map of inputs, written into the buffer of shard index when buffered (sharded or chunked batches)"""
+        N, C, H, W = self.nchw_shape(inputs)
+        out = None
+        if buffered:
+            h_out = (H + 2 * self.pad - self.pool_height)//self.stride + 1
+            w_out = (W + 2 * self.pad - self.pool_width)//self.stride + 1
+            out = self.get_scratch(('cols', index), (self.pool_height * self.pool_width, N * C * h_out * w_out), inputs.dtype, capacity)
+        if self.layout == 'CHWN':
+            # rows (channel, window), columns (out_height, out_width, batch)
+            if out is not None:
+                out = out.reshape(C * self.pool_height * self.pool_width, -1)
+            return im2col_chwn(inputs, self.pool_height, self.pool_width, padding=self.pad, stride=self.stride, out=out)
+        X_reshaped = inputs.reshape(N * C, 1, H, W)
+        return im2col(X_reshaped, self.pool_height, self.pool_width, padding=self.pad, stride=self.stride, engine=self.im2col_engine, out=out)
         
     def backward(self, in_grads, inputs):
         """Backward pass
@@ -350,41 +713,139 @@ class Pooling(Layer):
         out_grads = None
         #############################################################
         # code here        
-        X_reshaped = inputs.reshape(inputs.shape[0] * inputs.shape[1], 1, inputs.shape[2], inputs.shape[3])
-        X_col = im2col_indices(X_reshaped, self.pool_height, self.pool_width, padding=self.pad, stride=self.stride)
-
-        dX_col = np.zeros_like(X_col)
-        dinput_grads = in_grads.transpose(2, 3, 0, 1).ravel()
-
-        if self.pool_type == 'max':
-            max_idx = np.argmax(X_col, axis=0)
-            dX_col[max_idx, range(dinput_grads.size)] = dinput_grads
-
-        if self.pool_type == 'avg':
-            dX_col[:, range(dinput_grads.size)] = 1. / dX_col.shape[0] * dinput_grads
-
-        out_grads = col2im_indices(dX_col, (inputs.shape[0] * inputs.shape[1], 1, inputs.shape[2], inputs.shape[3]), self.pool_height, self.pool_width, padding=self.pad, stride=self.stride)
-        out_grads = out_grads.reshape(inputs.shape)
+        chwn = self.layout == 'CHWN'
+        shards = batch_shards(self.nchw_shape(inputs)[0], self.threads)
+        backend = self.get_backend()
+        chunks, per_sample = self.get_chunks(inputs, shards, backend)
+        buffered = len(shards) > 1 or any(len(shard_chunks) > 1 for shard_chunks in chunks)
+        max_idxs = self.get_cache(inputs)
+        if max_idxs is not None and len(max_idxs) != len(shards):
+            max_idxs = None
+        if buffered:
+            out_grads = np.empty(inputs.shape, dtype=in_grads.dtype)
+        window = self.pool_height * self.pool_width
+
+        def backward_shard(index, shard):
+            if backend == 'direct':
+                x = self.batch(inputs, shard)
+                max_idx = None
+                if self.pool_type == 'max':
+                    if max_idxs is not None:
+                        max_idx = max_idxs[index][0]
+                    else:
+                        _, max_idx = pooling.max_pool(x, self.pool_height, self.pool_width, self.stride, self.pad, chwn)
+                shard_grads = None if out_grads is None else self.batch(out_grads, shard)
+                return pooling.backward(self.batch(in_grads, shard), max_idx, x.shape, self.pool_height, self.pool_width, self.stride, self.pad, chwn, out=shard_grads)
+            capacity = (chunks[index][0].stop - chunks[index][0].start) * per_sample
+            for c, chunk in enumerate(chunks[index]):
+                N, C, H, W = self.nchw_shape(self.batch(inputs, chunk))
+                dY = self.batch(in_grads, chunk)
+                size = dY.size
+                if buffered:
+                    dX_col = self.get_scratch(('dcols', index), (window, size), in_grads.dtype, capacity)
+                    dX_col.fill(0)
+                else:
+                    dX_col = np.zeros((window, size), dtype=in_grads.dtype)
+
+                if chwn:
+                    dinput_grads = dY.reshape(C, 1, -1)
+                    dX_col = dX_col.reshape(C, window, -1)
+                else:
+                    dinput_grads = dY.transpose(2, 3, 0, 1).ravel()
+
+                if self.pool_type == 'max':
+                    if max_idxs is not None:
+                        max_idx = max_idxs[index][c]
+                    else:
+                        X_col = self.get_columns(self.batch(inputs, chunk), index, buffered, capacity)
+                        max_idx = np.argmax(X_col.reshape(C, window, -1), axis=1) if chwn else np.argmax(X_col, axis=0)
+                    if chwn:
+                        np.put_along_axis(dX_col, max_idx[:, None], dinput_grads, axis=1)
+                    else:
+                        dX_col[max_idx, range(size)] = dinput_grads
+
+                if self.pool_type == 'avg':
+                    dX_col[...] = 1. / window * dinput_grads
+
+                if chwn:
+                    chunk_grads = None if out_grads is None else self.batch(out_grads, chunk)
+                    chunk_grads = col2im_chwn(dX_col.reshape(C * window, -1), (C, H, W, N), self.pool_height, self.pool_width, padding=self.pad, stride=self.stride, out=chunk_grads)
+                else:
+                    chunk_grads = None if out_grads is None else out_grads[chunk].reshape(N * C, 1, H, W)
+                    chunk_grads = col2im(dX_col, (N * C, 1, H, W), self.pool_height, self.pool_width, padding=self.pad, stride=self.stride, out=chunk_grads).reshape(N, C, H, W)
+            return chunk_grads
+
+        results = map_shards(backward_shard, shards, self.threads)
+        if out_grads is None:
+            out_grads = results[0]
         #############################################################
 
         return out_grads
 
 class Dropout(Layer):
-    def __init__(self, ratio, name='dropout', seed=None):
+    def __init__(self, ratio, name='dropout', seed=None, step=0):
         """Initialization
 
         # Arguments
-            ratio: float [0, 1], the probability of setting a neuron to zero
-            seed: int, random seed to sample from inputs, so as to get mask. (default as None)
+            ratio: float [0, 1], the probability of keeping a neuron, kept ones are scaled by 1/ratio
+            seed: int, random seed of the masks, so as to reproduce them. (default as None, drawn from the OS and kept in self.seed)
+            step: int, the training step the next mask is drawn for, so a restored layer resumes its mask sequence
         """
         super(Dropout, self).__init__(name=name)
         self.ratio = ratio
-        self.mask = None
-        self.seed = seed
+        # an unseeded layer still gets a concrete seed, so checkpoints reproduce its masks
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        # counter-based generator private to the layer: the mask of a training step is
+        # a function of (key, step), so it can be regenerated instead of stored
+        self.key = np.random.SeedSequence(self.seed).generate_state(2, dtype=np.uint64)
+        self.step = step
+        self.advance = False # Whether the next training forward pass starts a new step
+        self.shard = None # (start, batch) when the inputs are a slice of a larger batch
+        # the mask of a sample depends on its place in the batch and on the batch size
+        self.independent_samples = False
+
+    def get_config(self):
+        return {'ratio': self.ratio, 'name': self.name, 'seed': self.seed, 'step': self.step + self.advance}
+
+    def set_shard(self, start, batch):
+        self.shard = None if batch is None else (start, batch)
+
+    def skip_step(self):
+        if self.advance:
+            self.step += 1
+            self.cache = None
+        self.advance = True
+
+    def get_mask(self, shape):
+        """Boolean keep-mask of the current step with shape
+
+        Kept in self.cache as packed bits (one bit per element) when keep_cache is set,
+        otherwise regenerated from (self.key, self.step) on every call. The mask of a
+        shard is the matching slice of the mask of its whole batch, so data-parallel
+        workers drop the same units as a single process would.
+        """
+        if self.cache is not None and self.cache[0] == shape:
+            return np.unpackbits(self.cache[1], count=int(np.prod(shape))).reshape(shape).view(bool)
+        # the step lives in the high words of the Philox counter, far from the blocks any mask draws
+        rng = np.random.Generator(np.random.Philox(key=self.key, counter=[0, 0, self.step, 0]))
+        if self.shard is None:
+            mask = rng.random(shape, dtype=np.float32) < self.ratio
+        else:
+            start, batch = self.shard
+            axis = 3 if self.layout == 'CHWN' and len(shape) == 4 else 0
+            full_shape = shape[:axis] + (batch,) + shape[axis+1:]
+            mask = rng.random(full_shape, dtype=np.float32) < self.ratio
+            mask = np.take(mask, np.arange(start, start + shape[axis]), axis=axis)
+        if self.keep_cache:
+            self.cache = (shape, np.packbits(mask, axis=None))
+        return mask
 
     def forward(self, inputs):
         """Forward pass (Hint: use self.training to decide the phrase/mode of the model)
 
+        Every training step (forward passes up to a backward pass) draws a new mask;
+        forward passes repeated within a step reuse it.
+
         # Arguments
             inputs: numpy array
 
@@ -395,10 +856,12 @@ class Dropout(Layer):
         #############################################################
         # code here
         if(self.training):
-            np.random.seed(self.seed) 
-            if self.mask is None:
-                self.mask = np.random.binomial(1, self.ratio, size=inputs.shape) / self.ratio
-            outputs = inputs * self.mask
+            if self.advance:
+                self.step += 1
+                self.advance = False
+                self.cache = None
+            outputs = inputs * self.get_mask(inputs.shape)
+            outputs *= inputs.dtype.type(1. / self.ratio)
         else:
             outputs = inputs
         #############################################################
@@ -418,10 +881,9 @@ class Dropout(Layer):
         #############################################################
         # code here
         if self.training == True:
-            np.random.seed(self.seed) 
-            if self.mask is None:
-                self.mask = np.random.binomial(1, self.ratio, size=inputs.shape) / self.ratio
-            out_grads = in_grads * self.mask
+            out_grads = in_grads * self.get_mask(inputs.shape)
+            out_grads *= in_grads.dtype.type(1. / self.ratio)
+            self.advance = True
         else:
             out_grads = in_grads
         #############################################################
@@ -442,6 +904,9 @@ class Flatten(Layer):
         # Returns
             outputs: numpy array with shape (batch, in_channel*in_height*in_width)
         """
+        if self.layout == 'CHWN':
+            # back to one row per sample, features in the same (channel, height, width) order
+            return np.ascontiguousarray(inputs.reshape(-1, inputs.shape[-1]).T)
         batch = inputs.shape[0]
         outputs = inputs.copy().reshape(batch, -1)
         return outputs
@@ -456,6 +921,8 @@ class Flatten(Layer):
         # Returns
             out_grads: numpy array with shape (batch, in_channel, in_height, in_width), gradients to inputs 
         """
+        if self.layout == 'CHWN':
+            return np.ascontiguousarray(in_grads.T).reshape(inputs.shape)
         out_grads = in_grads.copy().reshape(inputs.shape)
         return out_grads
         
@@ -4,7 +4,9 @@ class Loss(object):
     
     def __init__(self):
         self.trainable = False # Whether there are parameters in this layer that can be trained
-        self.training = False # The phrase, if for training then true
+        self.training = True # The phrase, if for training then true
+        self.keep_cache = False # Whether to keep forward-pass intermediates for the backward pass
+        self.cache = None
 
     def forward(self, inputs, targets):
         """Forward pass, reture outputs"""
@@ -18,6 +20,38 @@ class Loss(object):
         """Set the phrase/mode into training (True) or tesing (False)"""
         self.training = training
 
+    def set_dtype(self, dtype):
+        """Losses follow the dtype of their inputs and keep no parameters"""
+        pass
+
+    def set_layout(self, layout):
+        """Losses take (batch, num_class) inputs whatever the layout of the layers before them"""
+        pass
+
+    def set_shard(self, start, batch):
+        """Losses average over whatever part of the batch they are given"""
+        pass
+
+    def skip_step(self):
+        """Losses keep no per-step state"""
+        pass
+
+    def set_cache(self, keep_cache):
+        """Keep (True) or drop (False) forward-pass intermediates for the backward pass"""
+        self.keep_cache = keep_cache
+        if not keep_cache:
+            self.cache = None
+
+    def clear_cache(self):
+        """Release the intermediates kept by the last forward pass"""
+        self.cache = None
+
+    def get_cache(self, inputs):
+        """What the last forward pass kept, if that pass ran on inputs (None otherwise)"""
+        if self.cache is not None and self.cache[0] is inputs:
+            return self.cache[1]
+        return None
+
 
 class SoftmaxCrossEntropy(Loss):
     def __init__(self, num_class):
@@ -53,6 +87,7 @@ class SoftmaxCrossEntropy(Loss):
         log_probs = logits - np.log(Z)
         outputs = np.exp(log_probs)
         loss = -np.sum(log_probs[np.arange(N), targets]) / N
+        self.cache = (inputs, outputs) if self.keep_cache and self.training else None
         # outputs = probs.copy()
         # outputs[np.arange(N), targets] -= 1
         # outputs /= N
@@ -74,8 +109,13 @@ class SoftmaxCrossEntropy(Loss):
         # code here
         m = inputs.shape[0]
 
-        exps = np.exp((inputs.T - np.max(inputs, axis=1)).T)
-        prob = (exps.T / exps.sum(axis=1)).T
+        cached = self.get_cache(inputs)
+        if cached is not None:
+            # the probabilities were handed out by forward, so work on a copy
+            prob = cached.copy()
+        else:
+            exps = np.exp((inputs.T - np.max(inputs, axis=1)).T)
+            prob = (exps.T / exps.sum(axis=1)).T
         prob[range(m), targets] -= 1.
         prob /= m
 
@@ -92,6 +132,7 @@ class L2(Loss):
         """
         super(L2, self).__init__()
         self.w = w
+        self.buffers = {} # Scratch arrays for accumulate, one per key of params
 
     def forward(self, params):
         """Forward pass
@@ -120,4 +161,18 @@ class L2(Loss):
         out_grads = {}
         for k, v in params.items():
             out_grads[k] = self.w * params[k]
-        return out_grads
\ No newline at end of file
+        return out_grads
+
+    def accumulate(self, params, grads):
+        """Add the gradients of the regularization loss into grads in place
+
+        # Arguments
+            params: dictionary, store all weights of the whole model
+            grads: dictionary, gradients to all weights, same keys with params
+        """
+        for k, v in params.items():
+            buffer = self.buffers.get(k)
+            if buffer is None or buffer.shape != v.shape or buffer.dtype != v.dtype:
+                buffer = self.buffers[k] = np.empty_like(v)
+            np.multiply(v, self.w, out=buffer)
+            np.add(grads[k], buffer, out=grads[k])
\ No newline at end of file
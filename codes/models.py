@@ -1,28 +1,131 @@
 import numpy as np 
-import copy, pickle, sys
+import copy, math, pickle, sys
 from utils.tools import clip_gradients
+from parallel import DataParallel
+from inference import InferenceEngine
+from evaluation import evaluate, BackgroundEvaluator
+import checkpoint
 
 class Model():
     
-    def __init__(self):
+    def __init__(self, cache_activations=True, dtype=np.float64, layout='NCHW', segments=None):
+        """Initialization
+
+        # Arguments
+            cache_activations: bool, let layers keep forward-pass intermediates (im2col columns, argmax indices, probabilities) for the backward pass
+            dtype: numpy dtype used for inputs, parameters, gradients and optimizer state, e.g. np.float32
+            layout: string, axis order of 4-D activations between layers. 'CHWN' (channel, height, width, batch)
+                is what the im2col GEMM produces, so convolution and pooling need no transposes; inputs are
+                still given as (batch, channel, height, width) and converted once on the way in
+            segments: gradient checkpointing. None (default) keeps the inputs of every layer for the backward pass;
+                'sqrt' starts a segment every ceil(sqrt(L)) layers; a list of layer indices starts a segment at each.
+                Only the inputs of segment starts are kept (and no layer caches outside the last segment),
+                backward recomputes the rest one segment at a time, trading one extra forward pass for memory
+        """
+        self.cache_activations = cache_activations
+        self.dtype = np.dtype(dtype)
+        self.layout = layout
+        self.segments = segments
         self.layers = []
         self.inputs = None
         self.optimizer = None 
         self.regularization = None
+        self.params = None
+        self.grads = None
+        self.flat_params = None
+        self.flat_grads = None
+        self.clip = None
+        self.engine = None
+        self.profiler = None
 
     def add(self, layer):
         self.layers.append(layer)
+        self.engine = None
+
+    def compile(self, optimizer, loss, regularization=None, clip=None):
+        """Attach optimizer, loss and regularization, and pack the trainable parameters
 
-    def compile(self, optimizer, loss, regularization=None):
+        # Arguments
+            clip: float, clip every gradient into [-clip, clip] before the update (None to disable)
+        """
         self.optimizer = optimizer
         self.layers.append(loss)
         self.regularization = regularization
+        self.clip = clip
+        self.engine = None
+        for layer in self.layers:
+            layer.set_dtype(self.dtype)
+            layer.set_layout(self.layout)
+            layer.set_cache(self.cache_activations)
+        # layers before the last segment are recomputed in backward, they keep nothing in forward
+        for start, end in self.get_segments()[:-1]:
+            for layer in self.layers[start:end]:
+                layer.set_cache(False)
+        self.pack_params()
+
+    def get_segments(self):
+        """Split the layers into segments for gradient checkpointing
+
+        # Returns
+            segments: list of (start, end) layer index ranges covering self.layers in order
+        """
+        L = len(self.layers)
+        if self.segments is None:
+            return [(0, L)]
+        if self.segments == 'sqrt':
+            starts = list(range(0, L, max(math.ceil(math.sqrt(L)), 1)))
+        else:
+            starts = sorted(set([0] + [int(start) for start in self.segments]))
+            if starts[-1] >= L:
+                raise ValueError('Segment start %d is past the last layer (%d layers)' % (starts[-1], L))
+        return list(zip(starts, starts[1:] + [L]))
+
+    def pack_params(self, flat_params=None, flat_grads=None, copy=True):
+        """Move all trainable parameters and gradients into two contiguous flat buffers
+
+        Layers keep views into the buffers, so a single vectorized op over
+        self.flat_params/self.flat_grads touches every parameter of the model.
+
+        # Arguments
+            flat_params: numpy array, 1-D buffer to hold the parameters (None to allocate one)
+            flat_grads: numpy array, 1-D buffer to hold the gradients (None to allocate one)
+            copy: bool, copy the current parameters into flat_params (False to adopt the values already in it)
+        """
+        layers = [layer for layer in self.layers if layer.trainable]
+        size = sum(layer.weights.size + layer.bias.size for layer in layers)
+        if flat_params is None:
+            flat_params = np.empty(size, dtype=self.dtype)
+        if flat_grads is None:
+            flat_grads = np.zeros(size, dtype=self.dtype)
+
+        offset = 0
+        for layer in layers:
+            for param, grad in (('weights', 'w_grad'), ('bias', 'b_grad')):
+                value = getattr(layer, param)
+                end = offset + value.size
+                view = flat_params[offset:end].reshape(value.shape)
+                if copy:
+                    view[...] = value
+                setattr(layer, param, view)
+                setattr(layer, grad, flat_grads[offset:end].reshape(value.shape))
+                offset = end
+
+        self.flat_params = flat_params
+        self.flat_grads = flat_grads
+        # parameter registry, resolved once: layers update these arrays in place
+        self.params, self.grads = self.collect_params()
 
     def forward(self, inputs, targets):
         self.inputs = []
-        layer_inputs = inputs
+        layer_inputs = np.asarray(inputs, dtype=self.dtype)
+        if self.layout == 'CHWN' and layer_inputs.ndim == 4:
+            layer_inputs = np.ascontiguousarray(layer_inputs.transpose(1, 2, 3, 0))
+        # with checkpointing only segment starts and the last segment are kept
+        segments = self.get_segments()
+        kept = set(start for start, _ in segments)
+        kept.update(range(segments[-1][0], len(self.layers)))
         for l, layer in enumerate(self.layers):
-            self.inputs.append(layer_inputs)
+            self.inputs.append(layer_inputs if l in kept else None)
             if l==len(self.layers)-1:
                 layer_inputs, probs = layer.forward(layer_inputs, targets)
             else:
@@ -30,14 +133,80 @@ class Model():
         outputs = layer_inputs
         return outputs, probs
 
+    def set_shard(self, start, batch):
+        """Tell every layer that the next batches are samples start.. of a batch of size batch (None for whole batches)"""
+        for layer in self.layers:
+            layer.set_shard(start, batch)
+
+    def skip_step(self):
+        """Move the per-step state of every layer (e.g. Dropout masks) past a step run on DataParallel workers"""
+        for layer in self.layers:
+            layer.skip_step()
+
+    def save(self, path, background=False):
+        """Write parameters, optimizer state and architecture into a binary checkpoint (see checkpoint.py)
+
+        # Arguments
+            background: bool, write in a background thread so training does not stall
+
+        # Returns
+            thread: threading.Thread doing the write, join it to wait for the file
+        """
+        return checkpoint.save(self, path, background)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """Rebuild a compiled model from a checkpoint written by Model.save
+
+        # Arguments
+            mmap: bool, map the parameters from the file instead of reading them up front
+        """
+        return checkpoint.load(path, mmap)
+
+    def predict(self, inputs, probs=False, batch=None):
+        """Inference-only forward pass: no stored activations, no loss, no targets
+
+        # Arguments
+            inputs: numpy array with shape (batch, ...)
+            probs: bool, return softmax probabilities instead of logits
+            batch: int, run the inputs through in batches of this size (None for a single pass)
+
+        # Returns
+            outputs: numpy array with shape (batch, num_class)
+        """
+        if self.engine is None:
+            self.engine = InferenceEngine(self)
+        if batch is None:
+            return self.engine.predict(inputs, probs)
+        return np.concatenate([self.engine.predict(inputs[start:start+batch], probs) for start in range(0, len(inputs), batch)])
+
     def backward(self, targets):
-        for l, layer in enumerate(self.layers[::-1]):
-            if l==0:
-                grads = layer.backward(self.inputs[-1-l], targets)
-            else:
-                grads = layer.backward(grads, self.inputs[-1-l])
+        for start, end in self.get_segments()[::-1]:
+            if self.inputs[end-1] is None:
+                self.recompute(start, end)
+            for l in range(end-1, start-1, -1):
+                layer = self.layers[l]
+                if l==len(self.layers)-1:
+                    grads = layer.backward(self.inputs[l], targets)
+                else:
+                    grads = layer.backward(grads, self.inputs[l])
+                # the gradient has been consumed, release what forward kept for it
+                layer.clear_cache()
+                self.inputs[l] = None
 
-    def get_params(self):
+    def recompute(self, start, end):
+        """Rebuild the layer inputs of a checkpointed segment from the one kept at its start"""
+        layer_inputs = self.inputs[start]
+        for l in range(start, end-1):
+            layer = self.layers[l]
+            # keep the caches this time, the segment's backward pass comes right after and
+            # releases them; forward passes of later steps go back to keeping nothing
+            layer.keep_cache = self.cache_activations
+            layer_inputs = layer.forward(layer_inputs)
+            layer.keep_cache = False
+            self.inputs[l+1] = layer_inputs
+
+    def collect_params(self):
         params = {}
         grads = {}
         for l, layer in enumerate(self.layers):
@@ -45,6 +214,10 @@ class Model():
                 layer_params, layer_grads = layer.get_params('layer-%dth'%l)
                 params.update(layer_params)
                 grads.update(layer_grads)
+        return params, grads
+
+    def get_params(self):
+        params, grads = self.collect_params()
 
         if self.regularization:
             reg_grads = self.regularization.backward(params)
@@ -53,12 +226,21 @@ class Model():
         return params, grads
 
     def update(self, optimizer, iteration):
+        if optimizer.inplace:
+            # one flat array each, so regularization, clipping and the update are single vectorized ops
+            params, grads = {'flat': self.flat_params}, {'flat': self.flat_grads}
+            if self.regularization:
+                self.regularization.accumulate(params, grads)
+            if self.clip:
+                clip_gradients(self.flat_grads, self.clip, out=self.flat_grads)
+            optimizer.update(params, grads, iteration)
+            return
+
         params, grads = self.get_params()
 
-        # clip gradients
-        # for k, v in grads.items():
-        #     grads[k] = clip_gradients(v)
-        #     print(k, np.mean(np.abs(v)))
+        # clip gradients, grads are views into self.flat_grads
+        if self.clip:
+            clip_gradients(self.flat_grads, self.clip, out=self.flat_grads)
 
         new_params = optimizer.update(params, grads, iteration)
 
@@ -72,103 +254,121 @@ class Model():
                 }
                 layer.update(layer_params)
 
-    def train(self, dataset, train_batch=32, val_batch=1000, test_batch=1000, epochs=5, val_intervals=100, test_intervals=500, print_intervals=100):
-        train_loader = dataset.train_loader(train_batch)
+    def train(self, dataset, train_batch=32, val_batch=1000, test_batch=1000, epochs=5, val_intervals=100, test_intervals=500, print_intervals=100, workers=1, prefetch=0, background_eval=False):
+        # with background_eval, test and validation run in a thread on a copy of the parameters
+        evaluator = BackgroundEvaluator(self) if background_eval else None
+        # with several workers each batch is split across processes holding model replicas
+        parallel = DataParallel(self, workers).start() if workers > 1 else None
+        # with prefetch > 0 the next batches are gathered in a background thread; it draws
+        # its shuffles from np.random, so it starts only after the replicas above are built
+        if prefetch:
+            train_loader = dataset.prefetch_loader('train', train_batch, prefetch)
+        else:
+            train_loader = dataset.train_loader(train_batch)
         num_train = dataset.num_train
 
         train_results = []
         test_results = []
         val_results = []
 
-        for epoch in range(epochs):
-            print('Epoch %d: '%epoch, end='\n')
-            for iteration in range(num_train//train_batch):
+        try:
+            for epoch in range(epochs):
+                print('Epoch %d: '%epoch, end='\n')
+                for iteration in range(num_train//train_batch):
                 
-                total_iteration = epoch*(num_train//train_batch)+iteration
-                # output test loss and accuracy
-                if iteration % test_intervals == 0:
-                    test_loss, test_acc = self.test(dataset, test_batch)
-                    test_results.append([total_iteration, test_loss, test_acc])
-
-
-                if iteration % val_intervals == 0:
-                    val_loss, val_acc = self.val(dataset, val_batch)
-                    val_results.append([total_iteration, val_loss, val_acc])
+                    total_iteration = epoch*(num_train//train_batch)+iteration
+                    # output test loss and accuracy
+                    if evaluator:
+                        jobs = []
+                        if iteration % test_intervals == 0:
+                            jobs.append(('test', dataset.test_loader(test_batch)))
+                        if iteration % val_intervals == 0:
+                            jobs.append(('val', dataset.val_loader(val_batch)))
+                        if jobs:
+                            evaluator.submit(total_iteration, jobs)
+                    else:
+                        if iteration % test_intervals == 0:
+                            test_loss, test_acc = self.test(dataset, test_batch, prefetch)
+                            test_results.append([total_iteration, test_loss, test_acc])
 
-                x, y = next(train_loader)
-                loss, probs = self.forward(x, y)
-                acc = np.sum(np.argmax(probs, axis=-1)==y) / train_batch
-                train_results.append([total_iteration, loss, acc])
+                        if iteration % val_intervals == 0:
+                            val_loss, val_acc = self.val(dataset, val_batch, prefetch)
+                            val_results.append([total_iteration, val_loss, val_acc])
 
-                if self.regularization:
-                    params, _ = self.get_params()
-                    reg_loss = self.regularization.forward(params)
+                    x, y = next(train_loader)
+                    if parallel:
+                        loss, probs = parallel.forward_backward(x, y)
+                    else:
+                        loss, probs = self.forward(x, y)
+                    acc = np.sum(np.argmax(probs, axis=-1)==y) / train_batch
+                    train_results.append([total_iteration, loss, acc])
 
-                if iteration % print_intervals == 0:
-                    print('Iteration %d:\t'%iteration, end='')
-                    print('accuracy=%.5f, loss=%.5f'%(acc, loss), end='')
                     if self.regularization:
-                        print(', regularization loss=', reg_loss)
-                    else:
-                        print('\n')
+                        reg_loss = self.regularization.forward({'flat': self.flat_params})
+
+                    if iteration % print_intervals == 0:
+                        print('Iteration %d:\t'%iteration, end='')
+                        print('accuracy=%.5f, loss=%.5f'%(acc, loss), end='')
+                        if self.regularization:
+                            print(', regularization loss=', reg_loss)
+                        else:
+                            print('\n')
 
-                    # for layer in self.layers:
-                    #     if layer.trainable:
-                    #         print(layer.name, np.mean(np.abs(layer.weights)))
+                        # for layer in self.layers:
+                        #     if layer.trainable:
+                        #         print(layer.name, np.mean(np.abs(layer.weights)))
                 
-                self.backward(y)
-                self.update(self.optimizer, total_iteration)
+                    if not parallel:
+                        self.backward(y)
+                    self.update(self.optimizer, total_iteration)
+                    if self.profiler:
+                        self.profiler.step()
+            if evaluator:
+                evaluator.wait()
+                for total_iteration, name, metrics in evaluator.results:
+                    results = test_results if name == 'test' else val_results
+                    results.append([total_iteration, metrics.loss, metrics.accuracy])
+        finally:
+            if parallel:
+                parallel.close()
+            if prefetch:
+                train_loader.close()
         return np.array(train_results), np.array(val_results), np.array(test_results)
 
 
-    def test(self, dataset, test_batch):
-        # set the mode into testing mode
-        for layer in self.layers:
-            layer.set_mode(training=False)
-        test_loader = dataset.test_loader(test_batch)
-        num_test = dataset.num_test
-        num_accurate = 0
-        sum_loss = 0
-        try:
-            while True:
-                x, y = next(test_loader)
-                loss, probs = self.forward(x, y)
-                num_accurate += np.sum(np.argmax(probs, axis=-1)==y)
-                sum_loss += loss
-        except StopIteration:
-            avg_loss = sum_loss*test_batch/num_test
-            accuracy = num_accurate/num_test
-            print('Test accuracy=%.5f, loss=%.5f'%(accuracy, avg_loss))
-
-        # reset the mode into training for continous training
-        for layer in self.layers:
-            layer.set_mode(training=True)
+    def evaluate(self, batches, top_k=(5,)):
+        """Streaming inference-only evaluation (see evaluation.py)
 
-        return avg_loss, accuracy
-        
+        # Arguments
+            batches: iterable of (x, y) batches, the last one may be smaller
+            top_k: tuple of int, the k of every top-k accuracy to track
 
-    
-    def val(self, dataset, val_batch):
-        # set the mode into testing mode
-        for layer in self.layers:
-            layer.set_mode(training=False)
-        val_loader = dataset.val_loader(val_batch)
-        num_val = dataset.num_val
-        num_accurate = 0
-        sum_loss = 0
+        # Returns
+            metrics: RunningMetrics with loss, accuracy, top-k accuracies and the confusion matrix
+        """
+        return evaluate(self, batches, top_k)
+
+    def loader(self, dataset, split, batch, prefetch=0):
+        if prefetch:
+            return dataset.prefetch_loader(split, batch, prefetch)
+        return getattr(dataset, '%s_loader' % split)(batch)
+
+    def test(self, dataset, test_batch, prefetch=0):
+        test_loader = self.loader(dataset, 'test', test_batch, prefetch)
         try:
-            while True:
-                x, y = next(val_loader)
-                loss, probs = self.forward(x, y)
-                num_accurate += np.sum(np.argmax(probs, axis=-1)==y)
-                sum_loss += loss
-        except StopIteration:
-            avg_loss = sum_loss*val_batch/num_val
-            accuracy = num_accurate/num_val
-            print('Validation accuracy: %.5f, loss: %.5f'%(accuracy, avg_loss))
-
-        # reset the mode into training for continous training
-        for layer in self.layers:
-            layer.set_mode(training=True)
+            metrics = self.evaluate(test_loader)
+        finally:
+            if prefetch:
+                test_loader.close()
+        print('Test accuracy=%.5f, loss=%.5f'%(metrics.accuracy, metrics.loss))
+        return metrics.loss, metrics.accuracy
 
-        return avg_loss, accuracy
+    def val(self, dataset, val_batch, prefetch=0):
+        val_loader = self.loader(dataset, 'val', val_batch, prefetch)
+        try:
+            metrics = self.evaluate(val_loader)
+        finally:
+            if prefetch:
+                val_loader.close()
+        print('Validation accuracy: %.5f, loss: %.5f'%(metrics.accuracy, metrics.loss))
+        return metrics.loss, metrics.accuracy
@@ -4,17 +4,19 @@ changelog:
                      correct the implementation of RMSprop (self.accumulators[k] = self.rho * self.accumulators[k] + (1 - self.rho) * xs_grads[k]**2)
 """
 import numpy as np
-import copy
 
 class Optimizer():
     
-    def __init__(self, lr):
+    def __init__(self, lr, inplace=False):
         """Initialization
         
         # Arguments
             lr: float, learnig rate 
+            inplace: bool, update the arrays in xs in place with preallocated state instead of returning new arrays
         """
         self.lr = lr
+        self.inplace = inplace
+        self.buffers = None
 
     def update(self, x, x_grad, iteration):
         """Update parameters with gradients"""
@@ -33,17 +35,25 @@ class Optimizer():
         lr = func(self.lr, iteration)
         return lr
 
+    def init_buffers(self, xs):
+        """Preallocate one scratch array per parameter for the in-place updates"""
+        if not self.buffers:
+            self.buffers = {}
+            for k, v in xs.items():
+                self.buffers[k] = np.empty_like(v)
+
 class SGD(Optimizer):
     
-    def __init__(self, lr=0.01, momentum=0, decay=0, sheduler_func = None):
+    def __init__(self, lr=0.01, momentum=0, decay=0, sheduler_func = None, inplace=False):
         """Initialization
         
         # Arguments
             lr: float, learnig rate 
             momentum: float, the ratio of moments
             decay: float, the learning rate decay ratio
+            inplace: bool, update the arrays in xs in place
         """
-        super(SGD, self).__init__(lr)
+        super(SGD, self).__init__(lr, inplace)
         self.momentum = momentum
         self.moments = None
         self.decay = decay
@@ -58,7 +68,7 @@ class SGD(Optimizer):
             iteration: int, current iteration number in the whole training process (not in that epoch)
 
         # Returns
-            new_xs: dictionary, new weights of model
+            new_xs: dictionary, new weights of model (xs itself, updated, in inplace mode)
         """
         new_xs = {}
         if self.decay > 0:
@@ -70,20 +80,32 @@ class SGD(Optimizer):
         if not self.moments:
             self.moments = {}
             for k, v in xs_grads.items():
-                self.moments[k] = np.zeros(v.shape)
+                self.moments[k] = np.zeros_like(v)
 
-        prev_moments = copy.deepcopy(self.moments)
+        if self.inplace:
+            self.init_buffers(xs)
+            for k in xs:
+                step = self.buffers[k]
+                np.multiply(xs_grads[k], self.lr, out=step)
+                if self.momentum:
+                    self.moments[k] *= self.momentum
+                    self.moments[k] -= step
+                    xs[k] += self.moments[k]
+                else:
+                    xs[k] -= step
+            return xs
 
         for k in list(xs.keys()):
         #############################################################
         # remove pass and code in for loop
+            self.moments[k] = self.momentum * self.moments[k] - self.lr * xs_grads[k]
+            new_xs[k] = xs[k] + self.moments[k]
         #############################################################
-            pass
         return new_xs
 
 class Adam(Optimizer):
     
-    def __init__(self, lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=None, decay=0, sheduler_func=None):
+    def __init__(self, lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=None, decay=0, sheduler_func=None, inplace=False):
         """Initialization
         
         # Arguments
@@ -92,8 +114,9 @@ class Adam(Optimizer):
             beta_2: float
             epsilon: float, precision to avoid numerical error
             decay: float, the learning rate decay ratio
+            inplace: bool, update the arrays in xs in place
         """
-        super(Adam, self).__init__(lr)
+        super(Adam, self).__init__(lr, inplace)
         self.beta_1 = beta_1
         self.beta_2 = beta_2
         self.epsilon = epsilon
@@ -114,7 +137,7 @@ class Adam(Optimizer):
             iteration: int, current iteration number in the whole training process (not in that epoch)
 
         # Returns
-            new_xs: dictionary, new weights of model
+            new_xs: dictionary, new weights of model (xs itself, updated, in inplace mode)
         """
         new_xs = {}
         if self.decay > 0:
@@ -126,30 +149,56 @@ class Adam(Optimizer):
             self.moments = {}
             self.accumulators = {}
             for k,v in xs.items():
-                self.moments[k] = np.zeros(v.shape)
-                self.accumulators[k] = np.zeros(v.shape)
-        if iteration > 0:
-            for k in list(xs.keys()):
-            #############################################################
-            # remove pass and code in for loop
-                self.moments[k] = self.beta_1 * self.moments[k] + (1-self.beta_1) * xs_grads[k]
-                mt = self.moments[k] / (1 - self.beta_1**iteration)
-                self.accumulators[k] = self.beta_2 * self.accumulators[k] + (1-self.beta_2) * (xs_grads[k]**2)
-                vt = self.accumulators[k] / (1 - self.beta_2**iteration)
-                new_xs[k] = xs[k] - self.lr * mt / (np.sqrt(vt) + self.epsilon)
+                self.moments[k] = np.zeros_like(v)
+                self.accumulators[k] = np.zeros_like(v)
+        # the bias correction is undefined at iteration 0, so leave the weights as they are
+        if iteration == 0:
+            return xs if self.inplace else dict(xs)
+
+        if self.inplace:
+            self.init_buffers(xs)
+            correction_1 = 1 - self.beta_1**iteration
+            correction_2 = 1 - self.beta_2**iteration
+            for k in xs:
+                m, v, tmp = self.moments[k], self.accumulators[k], self.buffers[k]
+                m *= self.beta_1
+                np.multiply(xs_grads[k], 1-self.beta_1, out=tmp)
+                m += tmp
+                v *= self.beta_2
+                np.multiply(xs_grads[k], xs_grads[k], out=tmp)
+                tmp *= 1-self.beta_2
+                v += tmp
+                # x -= lr * (m / correction_1) / (sqrt(v / correction_2) + epsilon)
+                np.divide(v, correction_2, out=tmp)
+                np.sqrt(tmp, out=tmp)
+                tmp += self.epsilon
+                np.divide(m, tmp, out=tmp)
+                tmp *= self.lr / correction_1
+                xs[k] -= tmp
+            return xs
+
+        for k in list(xs.keys()):
+        #############################################################
+        # remove pass and code in for loop
+            self.moments[k] = self.beta_1 * self.moments[k] + (1-self.beta_1) * xs_grads[k]
+            mt = self.moments[k] / (1 - self.beta_1**iteration)
+            self.accumulators[k] = self.beta_2 * self.accumulators[k] + (1-self.beta_2) * (xs_grads[k]**2)
+            vt = self.accumulators[k] / (1 - self.beta_2**iteration)
+            new_xs[k] = xs[k] - self.lr * mt / (np.sqrt(vt) + self.epsilon)
     #############################################################
         return new_xs
 
 class Adagrad(Optimizer):
-    def __init__(self, lr=0.01, epsilon=None, decay=0, sheduler_func=None):
+    def __init__(self, lr=0.01, epsilon=None, decay=0, sheduler_func=None, inplace=False):
         """Initialization
         
         # Arguments
             lr: float, learnig rate 
             epsilon: float, precision to avoid numerical error
             decay: float, the learning rate decay ratio
+            inplace: bool, update the arrays in xs in place
         """
-        super(Adagrad, self).__init__(lr)
+        super(Adagrad, self).__init__(lr, inplace)
         self.epsilon = epsilon
         self.decay = decay
         if not self.epsilon:
@@ -166,7 +215,7 @@ class Adagrad(Optimizer):
             iteration: int, current iteration number in the whole training process (not in that epoch)
 
         # Returns
-            new_xs: dictionary, new weights of model
+            new_xs: dictionary, new weights of model (xs itself, updated, in inplace mode)
         """
         new_xs = {}
         if self.decay > 0:
@@ -176,14 +225,28 @@ class Adagrad(Optimizer):
         if not self.accumulators:
             self.accumulators = {}
             for k,v in xs.items():
-                self.accumulators[k] = np.zeros(v.shape)
+                self.accumulators[k] = np.zeros_like(v)
+
+        if self.inplace:
+            self.init_buffers(xs)
+            for k in xs:
+                acc, tmp = self.accumulators[k], self.buffers[k]
+                np.multiply(xs_grads[k], xs_grads[k], out=tmp)
+                acc += tmp
+                np.sqrt(acc, out=tmp)
+                tmp += self.epsilon
+                np.divide(xs_grads[k], tmp, out=tmp)
+                tmp *= self.lr
+                xs[k] -= tmp
+            return xs
+
         for k in list(xs.keys()):
             self.accumulators[k] += xs_grads[k]**2
             new_xs[k] = xs[k] - self.lr * xs_grads[k] / (np.sqrt(self.accumulators[k]) + self.epsilon)
         return new_xs
 
 class RMSprop(Optimizer):
-    def __init__(self, lr=0.001, rho=0.9, epsilon=None, decay=0, sheduler_func=None):
+    def __init__(self, lr=0.001, rho=0.9, epsilon=None, decay=0, sheduler_func=None, inplace=False):
         """Initialization
         
         # Arguments
@@ -191,8 +254,9 @@ class RMSprop(Optimizer):
             rho: float
             epsilon: float, precision to avoid numerical error
             decay: float, the learning rate decay ratio
+            inplace: bool, update the arrays in xs in place
         """
-        super(RMSprop, self).__init__(lr)
+        super(RMSprop, self).__init__(lr, inplace)
         self.rho = rho
         self.epsilon = epsilon
         self.decay = decay
@@ -210,7 +274,7 @@ class RMSprop(Optimizer):
             iteration: int, current iteration number in the whole training process (not in that epoch)
 
         # Returns
-            new_xs: dictionary, new weights of model
+            new_xs: dictionary, new weights of model (xs itself, updated, in inplace mode)
         """
         new_xs = {}
         if self.decay > 0:
@@ -220,8 +284,24 @@ class RMSprop(Optimizer):
         if not self.accumulators:
             self.accumulators = {}
             for k,v in xs.items():
-                self.accumulators[k] = np.zeros(v.shape)
+                self.accumulators[k] = np.zeros_like(v)
+
+        if self.inplace:
+            self.init_buffers(xs)
+            for k in xs:
+                acc, tmp = self.accumulators[k], self.buffers[k]
+                acc *= self.rho
+                np.multiply(xs_grads[k], xs_grads[k], out=tmp)
+                tmp *= 1 - self.rho
+                acc += tmp
+                np.add(acc, self.epsilon, out=tmp)
+                np.sqrt(tmp, out=tmp)
+                np.divide(xs_grads[k], tmp, out=tmp)
+                tmp *= self.lr
+                xs[k] -= tmp
+            return xs
+
         for k in list(xs.keys()):
             self.accumulators[k] = self.rho * self.accumulators[k] + (1 - self.rho) * xs_grads[k]**2
             new_xs[k] = xs[k] - self.lr * xs_grads[k] / (np.sqrt(self.accumulators[k] + self.epsilon))
-        return new_xs
\ No newline at end of file
+        return new_xs
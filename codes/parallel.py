@@ -0,0 +1,185 @@
+"""
+Parallel execution helpers.
+
+- Data-parallel training: every batch is split across worker processes that
+  each hold a replica of the model. Parameters live in one shared-memory
+  buffer that the master updates in place, and each worker writes its
+  gradients into its own row of a shared gradient buffer, which the master
+  reduces before the optimizer step.
+- Batch sharding inside a layer: shards of the batch run on a shared thread
+  pool, which pays off because NumPy releases the GIL in BLAS and in most
+  large array operations.
+"""
+
+import multiprocessing as mp
+import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+
+_thread_pools = {}
+# a forked child inherits the pools but not their threads
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_thread_pools.clear)
+
+
+def thread_pool(threads):
+    """Shared ThreadPoolExecutor with the given number of threads"""
+    pool = _thread_pools.get(threads)
+    if pool is None:
+        pool = _thread_pools[threads] = ThreadPoolExecutor(threads)
+    return pool
+
+
+def batch_shards(batch, shards):
+    """Split range(batch) into at most `shards` contiguous, non-empty slices"""
+    bounds = np.linspace(0, batch, max(min(shards, batch), 1) + 1).astype(int)
+    return [slice(bounds[i], bounds[i+1]) for i in range(len(bounds) - 1)]
+
+
+def batch_chunks(shard, per_sample, budget=None):
+    """Split a shard into consecutive slices of as many samples as fit in budget bytes at per_sample bytes each
+
+    The whole shard is a single chunk when budget is None, and every chunk holds at least one sample.
+    """
+    if budget is None:
+        return [shard]
+    size = max(int(budget // per_sample), 1)
+    return [slice(start, min(start + size, shard.stop)) for start in range(shard.start, shard.stop, size)]
+
+
+def map_shards(func, shards, threads=1):
+    """Return [func(index, shard) for each shard], run on the thread pool when threads > 1"""
+    if threads <= 1 or len(shards) == 1:
+        return [func(index, shard) for index, shard in enumerate(shards)]
+    return list(thread_pool(threads).map(func, range(len(shards)), shards))
+
+
+def _worker(conn, model, param_shm, grad_shm, index, workers):
+    size = model.flat_params.size
+    params = np.ndarray((size,), dtype=model.dtype, buffer=param_shm.buf)
+    grads = np.ndarray((workers, size), dtype=model.dtype, buffer=grad_shm.buf)[index]
+    # the master keeps the values in params up to date, do not overwrite them
+    model.pack_params(params, grads, copy=False)
+    try:
+        while True:
+            batch = conn.recv()
+            if batch is None:
+                break
+            x, y, start, size = batch
+            # layers drawing per-sample randomness need the place of the shard in the whole batch
+            model.set_shard(start, size)
+            loss, probs = model.forward(x, y)
+            model.backward(y)
+            conn.send((loss, probs))
+    finally:
+        # drop the views before closing, the buffers cannot be unmapped while exported
+        model.pack_params()
+        del params, grads
+        param_shm.close()
+        grad_shm.close()
+        conn.close()
+
+
+class DataParallel():
+
+    def __init__(self, model, workers=2):
+        """Initialization
+
+        # Arguments
+            model: Model, compiled model to train, its parameters are moved into shared memory by start()
+            workers: int, the number of worker processes
+        """
+        self.model = model
+        self.workers = workers
+        self.processes = []
+        self.conns = []
+        self.param_shm = None
+        self.grad_shm = None
+        self.worker_grads = None
+
+    def start(self):
+        """Move the parameters into shared memory and start the worker processes"""
+        model = self.model
+        size = model.flat_params.size
+        nbytes = max(size * model.dtype.itemsize, 1)
+        self.param_shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.grad_shm = shared_memory.SharedMemory(create=True, size=nbytes * self.workers)
+        params = np.ndarray((size,), dtype=model.dtype, buffer=self.param_shm.buf)
+        self.worker_grads = np.ndarray((self.workers, size), dtype=model.dtype, buffer=self.grad_shm.buf)
+        model.pack_params(params, model.flat_grads)
+
+        # fork hands the replica to the workers without pickling it
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context('fork' if 'fork' in methods else None)
+        for index in range(self.workers):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(child_conn, model, self.param_shm, self.grad_shm, index, self.workers), daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.conns.append(conn)
+        return self
+
+    def forward_backward(self, inputs, targets):
+        """Forward and backward pass of one batch split across the workers
+
+        The gradients of the whole batch are reduced into model.flat_grads.
+
+        # Arguments
+            inputs: numpy array with shape (batch, ...)
+            targets: numpy array with shape (batch,)
+
+        # Returns
+            loss: float, batch loss
+            probs: numpy array with shape (batch, num_class)
+        """
+        batch = inputs.shape[0]
+        bounds = np.linspace(0, batch, self.workers + 1).astype(int)
+        active = []
+        for index, conn in enumerate(self.conns):
+            start, end = bounds[index], bounds[index+1]
+            if end > start:
+                conn.send((inputs[start:end], targets[start:end], start, batch))
+                active.append(index)
+
+        # every worker averaged over its own shard, so weight each by its share of the batch
+        weights = np.zeros(self.workers, dtype=self.model.dtype)
+        loss = 0
+        probs = []
+        for index in active:
+            shard_loss, shard_probs = self.conns[index].recv()
+            share = (bounds[index+1] - bounds[index]) / batch
+            weights[index] = share
+            loss += share * shard_loss
+            probs.append(shard_probs)
+        np.matmul(weights, self.worker_grads, out=self.model.flat_grads)
+        # the step ran on the replicas, keep the master's per-step state in line for checkpoints
+        self.model.skip_step()
+        return loss, np.concatenate(probs)
+
+    def close(self):
+        """Stop the workers and move the parameters back into private memory"""
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        for conn in self.conns:
+            conn.close()
+        self.processes = []
+        self.conns = []
+
+        self.model.pack_params()
+        self.worker_grads = None
+        for shm in (self.param_shm, self.grad_shm):
+            shm.close()
+            shm.unlink()
+        self.param_shm = None
+        self.grad_shm = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
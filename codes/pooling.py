@@ -0,0 +1,154 @@
+"""
+Direct max/avg pooling kernels, without im2col.
+
+Every window offset (di, dj) is a zero-copy strided view of the (padded)
+inputs with the shape of the outputs. Forward passes reduce these
+pool_h*pool_w views into the outputs with elementwise ufuncs, so nothing
+larger than the outputs is ever allocated. Max pooling records, per output,
+the offset of the maximum as one uint8 (the first one on ties, like
+np.argmax over im2col columns). Backward passes route the output gradients
+back through the same views, masked by that compact argmax for max pooling.
+
+Overlapping windows (e.g. 3x3 stride 2) and non-overlapping ones (2x2
+stride 2) go through the same code. Reducing a reshape-to-blocks view, or a
+sliding_window_view, over its window axes measured several times slower
+than these passes.
+
+Both activation layouts are supported: (batch, channel, height, width), and
+(channel, height, width, batch) with chwn=True.
+"""
+
+import numpy as np
+
+
+def supported(pool_height, pool_width):
+    """Whether the argmax of a window fits the uint8 mask"""
+    return pool_height * pool_width <= 256
+
+
+def output_size(in_height, in_width, pool_height, pool_width, stride, pad):
+    return (in_height + 2 * pad - pool_height) // stride + 1, (in_width + 2 * pad - pool_width) // stride + 1
+
+
+def spatial_shape(shape, chwn):
+    return shape[1:3] if chwn else shape[2:4]
+
+
+def pad_inputs(inputs, pad, chwn):
+    if pad == 0:
+        return inputs
+    widths = ((0, 0), (pad, pad), (pad, pad), (0, 0)) if chwn else ((0, 0), (0, 0), (pad, pad), (pad, pad))
+    return np.pad(inputs, widths, mode='constant')
+
+
+def window(x, di, dj, stride, h_out, w_out, chwn):
+    """The element at offset (di, dj) of every window, a view shaped like the outputs"""
+    rows = slice(di, di + stride * (h_out - 1) + 1, stride)
+    cols = slice(dj, dj + stride * (w_out - 1) + 1, stride)
+    return x[:, rows, cols] if chwn else x[:, :, rows, cols]
+
+
+def max_pool(inputs, pool_height, pool_width, stride, pad=0, chwn=False, argmax=True):
+    """Max pooling
+
+    # Arguments
+        inputs: numpy array, 4-D in the layout given by chwn
+        argmax: bool, also return the offset of the maximum in every window
+
+    # Returns
+        outputs: numpy array, 4-D in the same layout
+        max_idx: numpy array of uint8 shaped like outputs (None if not argmax)
+    """
+    h_out, w_out = output_size(*spatial_shape(inputs.shape, chwn), pool_height, pool_width, stride, pad)
+    x = pad_inputs(inputs, pad, chwn)
+    offsets = [(di, dj) for di in range(pool_height) for dj in range(pool_width)]
+    outputs = window(x, 0, 0, stride, h_out, w_out, chwn).copy()
+    for di, dj in offsets[1:]:
+        np.maximum(outputs, window(x, di, dj, stride, h_out, w_out, chwn), out=outputs)
+    if not argmax:
+        return outputs, None
+
+    # walk the offsets backwards so the first maximum of a window is the one kept;
+    # max_idx += (k - max_idx) * mask wraps around in uint8 but lands on k,
+    # and plain arithmetic is several times faster than ufuncs with where=
+    max_idx = np.zeros(outputs.shape, dtype=np.uint8)
+    mask = np.empty(outputs.shape, dtype=bool)
+    step = np.empty(outputs.shape, dtype=np.uint8)
+    for k in range(len(offsets) - 1, -1, -1):
+        np.equal(window(x, *offsets[k], stride, h_out, w_out, chwn), outputs, out=mask)
+        np.subtract(np.uint8(k), max_idx, out=step)
+        np.multiply(step, mask, out=step)
+        max_idx += step
+    return outputs, max_idx
+
+
+def avg_pool(inputs, pool_height, pool_width, stride, pad=0, chwn=False):
+    """Average pooling (zero padding counts towards the average, as in the im2col path)"""
+    h_out, w_out = output_size(*spatial_shape(inputs.shape, chwn), pool_height, pool_width, stride, pad)
+    x = pad_inputs(inputs, pad, chwn)
+    outputs = window(x, 0, 0, stride, h_out, w_out, chwn).copy()
+    for di in range(pool_height):
+        for dj in range(pool_width):
+            if di or dj:
+                outputs += window(x, di, dj, stride, h_out, w_out, chwn)
+    outputs *= 1. / (pool_height * pool_width)
+    return outputs
+
+
+def backward(in_grads, max_idx, input_shape, pool_height, pool_width, stride, pad=0, chwn=False, out=None):
+    """Gradients to the inputs of max_pool (max_idx given) or avg_pool (max_idx None)
+
+    # Arguments
+        in_grads: numpy array, gradients to the outputs
+        max_idx: numpy array, the argmax returned by max_pool, or None for average pooling
+        input_shape: tuple, the shape of the forward inputs
+        out: numpy array the gradients are written into (None for a new one)
+
+    # Returns
+        out_grads: numpy array with shape input_shape
+    """
+    H, W = spatial_shape(input_shape, chwn)
+    h_out, w_out = output_size(H, W, pool_height, pool_width, stride, pad)
+    padded_shape = list(input_shape)
+    axes = (1, 2) if chwn else (2, 3)
+    for axis in axes:
+        padded_shape[axis] += 2 * pad
+    if pad == 0 and out is not None:
+        dx = out
+        dx.fill(0)
+    else:
+        dx = np.zeros(padded_shape, dtype=in_grads.dtype)
+
+    # windows that do not overlap write every input at most once
+    overlap = stride < pool_height or stride < pool_width
+    if max_idx is None:
+        scaled = in_grads * (1. / (pool_height * pool_width))
+    else:
+        mask = np.empty(in_grads.shape, dtype=bool)
+        if overlap:
+            routed = np.empty(in_grads.shape, dtype=in_grads.dtype)
+    k = 0
+    for di in range(pool_height):
+        for dj in range(pool_width):
+            view = window(dx, di, dj, stride, h_out, w_out, chwn)
+            if max_idx is None:
+                if overlap:
+                    view += scaled
+                else:
+                    view[...] = scaled
+            else:
+                np.equal(max_idx, k, out=mask)
+                if overlap:
+                    np.multiply(in_grads, mask, out=routed)
+                    view += routed
+                else:
+                    np.multiply(in_grads, mask, out=view)
+            k += 1
+
+    if pad:
+        dx = dx[:, pad:-pad, pad:-pad] if chwn else dx[:, :, pad:-pad, pad:-pad]
+        if out is not None:
+            out[...] = dx
+            return out
+        return np.ascontiguousarray(dx)
+    return dx
@@ -0,0 +1,172 @@
+"""
+Opt-in per-layer profiling.
+
+Profiler.attach(model) wraps the forward/backward of every layer and of the
+loss, Model.get_params, the optimizer's update and the im2col/col2im kernels
+called by the layers. Each call is recorded with its wall time and, with
+memory=True, the bytes allocated (peak above the level at entry, measured
+with tracemalloc). Model.train marks iteration boundaries. Nothing is
+wrapped until attach() is called, and detach() restores the original
+methods, so a model that is not being profiled pays nothing.
+
+Results are available as a summary table, per-iteration totals and a
+Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+import layers as layers_module
+
+
+class Profiler():
+
+    def __init__(self, memory=True):
+        """Initialization
+
+        # Arguments
+            memory: bool, also record bytes allocated per call (tracemalloc makes calls noticeably slower)
+        """
+        self.memory = memory
+        self.events = []
+        self.iteration = 0
+        self.patches = []
+        self.model = None
+        self.started_tracemalloc = False
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def attach(self, model):
+        """Wrap the layers, loss, get_params, optimizer and im2col/col2im used by model"""
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        for l, layer in enumerate(model.layers):
+            name = getattr(layer, 'name', type(layer).__name__)
+            category = 'loss' if l == len(model.layers) - 1 else 'layer'
+            self.patch(layer, 'forward', '%s/forward' % name, category)
+            self.patch(layer, 'backward', '%s/backward' % name, category)
+        self.patch(model, 'get_params', 'get_params', 'model')
+        if model.optimizer is not None:
+            self.patch(model.optimizer, 'update', 'optimizer.update', 'optimizer')
+        self.patch(layers_module, 'im2col', 'im2col', 'kernel')
+        self.patch(layers_module, 'col2im', 'col2im', 'kernel')
+        self.patch(layers_module, 'im2col_chwn', 'im2col', 'kernel')
+        self.patch(layers_module, 'col2im_chwn', 'col2im', 'kernel')
+        model.profiler = self
+        self.model = model
+        return self
+
+    def detach(self):
+        """Restore every wrapped function"""
+        for obj, attr, original, owned in reversed(self.patches):
+            if owned:
+                setattr(obj, attr, original)
+            else:
+                delattr(obj, attr)
+        self.patches = []
+        if self.model is not None:
+            self.model.profiler = None
+            self.model = None
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def patch(self, obj, attr, name, category):
+        original = getattr(obj, attr)
+        # instance attributes shadow the class method and are simply deleted again on detach
+        owned = attr in vars(obj) if hasattr(obj, '__dict__') else True
+        self.patches.append((obj, attr, original, owned))
+        setattr(obj, attr, self.wrap(original, name, category))
+
+    def wrap(self, func, name, category):
+        def wrapped(*args, **kwargs):
+            stack = getattr(self.local, 'stack', None)
+            if stack is None:
+                stack = self.local.stack = []
+            frame = self.enter(stack)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                allocated = self.leave(stack, frame)
+                self.events.append((name, category, start, end - start, allocated, self.iteration, threading.get_ident()))
+        wrapped.__wrapped__ = func
+        return wrapped
+
+    def enter(self, stack):
+        if not self.memory:
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak so far belongs to the enclosing call, hand it over before resetting
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        frame = [current, current]
+        stack.append(frame)
+        return frame
+
+    def leave(self, stack, frame):
+        if frame is None:
+            return 0
+        _, peak = tracemalloc.get_traced_memory()
+        stack.pop()
+        peak = max(frame[1], peak)
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        return peak - frame[0]
+
+    def step(self):
+        """Mark the end of a training iteration"""
+        self.iteration += 1
+
+    def reset(self):
+        self.events = []
+        self.iteration = 0
+
+    def per_iteration(self):
+        """List with, for every iteration, a dictionary of total seconds per recorded name"""
+        iterations = [OrderedDict() for _ in range(self.iteration + 1)]
+        for name, _, _, duration, _, iteration, _ in self.events:
+            totals = iterations[iteration]
+            totals[name] = totals.get(name, 0) + duration
+        return iterations if iterations[-1] else iterations[:-1]
+
+    def summary(self):
+        """Table of calls, time and allocations per recorded name, slowest first"""
+        stats = OrderedDict()
+        for name, _, _, duration, allocated, _, _ in self.events:
+            entry = stats.setdefault(name, [0, 0.0, 0, 0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] += allocated
+            entry[3] = max(entry[3], allocated)
+        iterations = max(self.iteration, 1)
+        lines = ['%-28s %8s %12s %10s %12s %12s' % ('name', 'calls', 'total(ms)', 'ms/iter', 'mean(KB)', 'max(KB)')]
+        for name, (calls, total, allocated, largest) in sorted(stats.items(), key=lambda item: -item[1][1]):
+            lines.append('%-28s %8d %12.2f %10.3f %12.1f %12.1f' % (name, calls, total * 1e3, total * 1e3 / iterations, allocated / calls / 1024, largest / 1024))
+        return '\n'.join(lines)
+
+    def chrome_trace(self, path=None):
+        """Events in the Chrome trace event format, written to path as JSON if given"""
+        pid = os.getpid()
+        events = [{
+            'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+            'args': {'bytes': allocated, 'iteration': iteration},
+        } for name, category, start, duration, allocated, iteration, tid in self.events]
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
@@ -0,0 +1,156 @@
+"""
+Online inference with dynamic micro-batching.
+
+Single-image requests are queued and coalesced into micro-batches bounded by
+a maximum batch size and a maximum wait time, and every micro-batch runs one
+vectorized Model.predict. Everything runs in-process on an asyncio event
+loop; LocalClient is the request API.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class BatchingServer():
+
+    def __init__(self, model, max_batch=64, max_wait=0.005, probs=True):
+        """Initialization
+
+        # Arguments
+            model: Model, compiled model, served through Model.predict
+            max_batch: int, the largest micro-batch
+            max_wait: float, seconds the first request of a micro-batch waits for more to arrive
+            probs: bool, answer with probabilities (True) or logits (False)
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.probs = probs
+        self.queue = None
+        self.task = None
+        self.executor = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.latencies = []
+        self.batch_sizes = []
+        self.first_arrival = None
+        self.last_reply = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        # one thread runs the forward passes, so the event loop keeps accepting requests meanwhile
+        self.executor = ThreadPoolExecutor(1)
+        self.task = asyncio.get_running_loop().create_task(self.batcher())
+        return self
+
+    async def stop(self):
+        """Answer the requests queued before this call, fail the ones queued after it, then stop"""
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+        # the batcher stopped at the sentinel, nothing would ever answer what came after it
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None and not item[1].done():
+                item[1].set_exception(RuntimeError('server stopped'))
+        self.executor.shutdown(wait=True)
+        self.executor = None
+
+    async def predict(self, image):
+        """Submit one image and wait for its row of outputs
+
+        # Arguments
+            image: numpy array with shape (in_channel, in_height, in_width)
+
+        # Returns
+            outputs: numpy array with shape (num_class,)
+        """
+        if self.task is None:
+            raise RuntimeError('the server is not running, call start() first')
+        future = asyncio.get_running_loop().create_future()
+        arrival = time.perf_counter()
+        if self.first_arrival is None:
+            self.first_arrival = arrival
+        await self.queue.put((image, future, arrival))
+        return await future
+
+    async def next_batch(self):
+        """Wait for a request, then collect more until max_batch or max_wait is reached"""
+        loop = asyncio.get_running_loop()
+        item = await self.queue.get()
+        if item is None:
+            return None, True
+        batch = [item]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch, stopping = await self.next_batch()
+            if not batch:
+                continue
+            inputs = np.stack([image for image, _, _ in batch])
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.model.predict, inputs, self.probs)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            reply = time.perf_counter()
+            for (_, future, arrival), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+                self.latencies.append(reply - arrival)
+            self.batch_sizes.append(len(batch))
+            self.last_reply = reply
+
+    def stats(self):
+        """Latency percentiles (seconds), throughput (requests per second) and batching summary"""
+        if not self.latencies:
+            return {'requests': 0, 'batches': 0}
+        latencies = np.array(self.latencies)
+        elapsed = self.last_reply - self.first_arrival
+        return {
+            'requests': len(latencies),
+            'batches': len(self.batch_sizes),
+            'mean_batch': float(np.mean(self.batch_sizes)),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+            'throughput': len(latencies) / elapsed if elapsed > 0 else float('inf'),
+        }
+
+
+class LocalClient():
+
+    def __init__(self, server):
+        self.server = server
+
+    async def predict(self, image):
+        return await self.server.predict(image)
+
+    async def predict_many(self, images):
+        """Submit every image as its own concurrent request"""
+        return np.stack(await asyncio.gather(*[self.server.predict(image) for image in images]))
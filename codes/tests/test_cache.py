@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from layers import Convolution, Pooling
+from loss import SoftmaxCrossEntropy
+from utils.check_grads import check_grads_layer, check_grads_loss
+
+CONV = {'kernel_h': 3, 'kernel_w': 3, 'pad': 1, 'stride': 1, 'in_channel': 2, 'out_channel': 3, 'backend': 'im2col'}
+POOL = {'pool_type': 'max', 'pool_height': 2, 'pool_width': 2, 'stride': 2, 'pad': 0}
+
+
+def fresh_backward(make, x, in_grads):
+    layer = make()
+    layer.forward(x)
+    out_grads = layer.backward(in_grads, x)
+    return out_grads, getattr(layer, 'w_grad', None)
+
+
+@pytest.mark.parametrize('make', [lambda: Convolution(CONV), lambda: Pooling(POOL)])
+@pytest.mark.parametrize('second_pass', ['eval', 'chunked', 'other_inputs'])
+def test_backward_never_uses_a_stale_cache(make, second_pass):
+    rng = np.random.RandomState(0)
+    x1, x2 = rng.randn(4, 2, 8, 8), rng.randn(4, 2, 8, 8)
+    np.random.seed(0)
+    layer = make()
+    layer.set_cache(True)
+    in_grads = rng.randn(*layer.forward(x1).shape)
+    # a training pass that keeps a cache, then a pass over x2 that does not
+    if second_pass == 'eval':
+        layer.set_mode(False)
+        layer.forward(x2)
+        layer.set_mode(True)
+    elif second_pass == 'chunked':
+        layer.memory_budget = 1
+        layer.forward(x2)
+    else:
+        layer.forward(x1)
+        x2 = x1.copy()
+        x2[0, 0, 0, 0] += 1.
+    out_grads = layer.backward(in_grads, x2)
+    layer.memory_budget = None
+
+    np.random.seed(0)
+    expected_out, expected_w = fresh_backward(make, x2, in_grads)
+    np.testing.assert_allclose(out_grads, expected_out, rtol=1e-12, atol=1e-12)
+    if expected_w is not None:
+        np.testing.assert_allclose(layer.w_grad, expected_w, rtol=1e-12, atol=1e-12)
+
+
+def test_loss_backward_never_uses_a_stale_cache():
+    rng = np.random.RandomState(0)
+    x1, x2 = rng.randn(5, 10), rng.randn(5, 10)
+    targets = rng.randint(10, size=5)
+    loss = SoftmaxCrossEntropy(10)
+    loss.set_cache(True)
+    loss.forward(x1, targets)
+    expected = SoftmaxCrossEntropy(10).backward(x2, targets)
+    np.testing.assert_allclose(loss.backward(x2, targets), expected, rtol=1e-12, atol=1e-14)
+
+
+def test_gradient_check_of_a_cached_convolution():
+    rng = np.random.RandomState(0)
+    layer = Convolution(CONV)
+    layer.set_cache(True)
+    x = rng.randn(2, 2, 6, 6)
+    in_grads = rng.randn(*layer.forward(x).shape)
+    results = check_grads_layer(layer, x, in_grads)
+    assert max(results.values()) < 1e-8
+    assert layer.keep_cache
+
+
+def test_gradient_check_of_a_cached_loss():
+    rng = np.random.RandomState(0)
+    loss = SoftmaxCrossEntropy(10)
+    loss.set_cache(True)
+    assert check_grads_loss(loss, rng.randn(5, 10), rng.randint(10, size=5)) < 1e-8
+    assert loss.keep_cache
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from applications import MNISTNet
+from layers import Convolution, Dropout, Pooling, ReLU
+from loss import SoftmaxCrossEntropy
+from optimizers import SGD
+from utils.check_grads import check_grads_layer, check_grads_model
+
+
+def mnistnet(layout):
+    np.random.seed(0)
+    model = MNISTNet(layout=layout)
+    model.compile(SGD(lr=0.01), SoftmaxCrossEntropy(10))
+    # at the initial scale (std 0.001) most ReLU inputs sit within h of their kink
+    model.flat_params[...] = np.random.RandomState(0).randn(model.flat_params.size) * 0.1
+    return model
+
+
+def batch(n=4):
+    rng = np.random.RandomState(1)
+    return rng.rand(n, 1, 28, 28), rng.randint(10, size=n)
+
+
+@pytest.mark.parametrize('layout', ['NCHW', 'CHWN'])
+def test_model_gradients(layout):
+    x, y = batch()
+    assert check_grads_model(mnistnet(layout), x, y, seed=0) < 1e-7
+
+
+def test_model_gradients_catch_a_wrong_backward(monkeypatch):
+    backward = ReLU.backward
+    monkeypatch.setattr(ReLU, 'backward', lambda self, in_grads, inputs: 1.1 * backward(self, in_grads, inputs))
+    x, y = batch()
+    assert check_grads_model(mnistnet('NCHW'), x, y, seed=0) > 1e-3
+
+
+@pytest.mark.parametrize('layout', ['NCHW', 'CHWN'])
+def test_fast_layer_check_in_both_layouts(layout):
+    rng = np.random.RandomState(0)
+    x = rng.randn(3, 2, 7, 6)
+    if layout == 'CHWN':
+        x = np.ascontiguousarray(x.transpose(1, 2, 3, 0))
+    for layer in (Convolution({'kernel_h': 3, 'kernel_w': 3, 'pad': 1, 'stride': 2, 'in_channel': 2, 'out_channel': 3}),
+                  Pooling({'pool_type': 'max', 'pool_height': 2, 'pool_width': 2, 'stride': 2, 'pad': 0})):
+        layer.set_layout(layout)
+        in_grads = rng.randn(*layer.forward(x).shape)
+        layer.clear_cache()
+        results = check_grads_layer(layer, x, in_grads, fast=True)
+        assert max(results.values()) < 1e-7
+
+
+def test_fast_layer_check_of_dropout():
+    rng = np.random.RandomState(0)
+    results = check_grads_layer(Dropout(0.5, seed=1), rng.randn(4, 20), rng.randn(4, 20), fast=True)
+    assert results['inputs'] < 1e-8
+
+
+def test_layer_check_leaves_the_model_untouched():
+    model = MNISTNet(dtype=np.float32)
+    model.compile(SGD(lr=0.01), SoftmaxCrossEntropy(10))
+    fc = model.layers[-2]
+    rng = np.random.RandomState(0)
+    check_grads_layer(fc, rng.randn(2, 256), rng.randn(2, 10))
+    assert fc.weights.dtype == np.float32
+    assert np.shares_memory(fc.weights, model.flat_params)
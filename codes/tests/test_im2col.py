@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from im2col import col2im_indices, col2im_slices, im2col_indices, im2col_strided
+
+# (field_height, field_width, padding, stride)
+GEOMETRIES = [(3, 3, 1, 1), (3, 3, 0, 1), (5, 5, 2, 1), (3, 3, 1, 2), (2, 2, 0, 2), (3, 2, 1, 3), (1, 1, 0, 1)]
+
+
+def naive_im2col(x, field_height, field_width, padding, stride):
+    N, C, H, W = x.shape
+    x = np.pad(x, ((0, 0), (0, 0), (padding, padding), (padding, padding)), mode='constant')
+    out_height = (H + 2 * padding - field_height) // stride + 1
+    out_width = (W + 2 * padding - field_width) // stride + 1
+    cols = np.empty((C, field_height, field_width, out_height, out_width, N))
+    for h in range(out_height):
+        for w in range(out_width):
+            patch = x[:, :, h * stride:h * stride + field_height, w * stride:w * stride + field_width]
+            cols[:, :, :, h, w, :] = patch.transpose(1, 2, 3, 0)
+    return cols.reshape(C * field_height * field_width, -1)
+
+
+@pytest.mark.parametrize('field_height, field_width, padding, stride', GEOMETRIES)
+@pytest.mark.parametrize('shape', [(2, 3, 8, 8), (3, 2, 7, 9)])
+def test_im2col_indices_matches_loops(shape, field_height, field_width, padding, stride):
+    x = np.random.RandomState(0).randn(*shape)
+    expected = naive_im2col(x, field_height, field_width, padding, stride)
+    np.testing.assert_array_equal(im2col_indices(x, field_height, field_width, padding, stride), expected)
+
+    out = np.empty_like(expected)
+    assert im2col_indices(x, field_height, field_width, padding, stride, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('field_height, field_width, padding, stride', GEOMETRIES)
+@pytest.mark.parametrize('shape', [(2, 3, 8, 8), (3, 2, 7, 9)])
+def test_im2col_strided_matches_indices(shape, field_height, field_width, padding, stride):
+    x = np.random.RandomState(0).randn(*shape)
+    expected = im2col_indices(x, field_height, field_width, padding, stride)
+    np.testing.assert_array_equal(im2col_strided(x, field_height, field_width, padding, stride), expected)
+
+    out = np.empty_like(expected)
+    assert im2col_strided(x, field_height, field_width, padding, stride, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('field_height, field_width, padding, stride', GEOMETRIES)
+@pytest.mark.parametrize('shape', [(2, 3, 8, 8), (3, 2, 7, 9)])
+def test_col2im_slices_matches_indices(shape, field_height, field_width, padding, stride):
+    cols = im2col_indices(np.zeros(shape), field_height, field_width, padding, stride)
+    cols = np.random.RandomState(1).randn(*cols.shape)
+    expected = col2im_indices(cols, shape, field_height, field_width, padding, stride)
+    np.testing.assert_allclose(col2im_slices(cols, shape, field_height, field_width, padding, stride), expected, rtol=1e-12, atol=1e-12)
+
+    out = np.empty(shape)
+    assert col2im_slices(cols, shape, field_height, field_width, padding, stride, out=out) is out
+    np.testing.assert_allclose(out, expected, rtol=1e-12, atol=1e-12)
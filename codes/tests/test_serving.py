@@ -0,0 +1,36 @@
+import asyncio
+import numpy as np
+import pytest
+from applications import MNISTNet
+from loss import SoftmaxCrossEntropy
+from optimizers import SGD
+from serving import BatchingServer
+
+
+def model():
+    np.random.seed(0)
+    model = MNISTNet()
+    model.compile(SGD(), SoftmaxCrossEntropy(10))
+    return model
+
+
+def test_requests_match_predict_and_late_ones_fail_on_stop():
+    net = model()
+    images = np.random.RandomState(0).rand(6, 1, 28, 28)
+
+    async def scenario():
+        server = await BatchingServer(net, max_batch=4, max_wait=0.001).start()
+        early = [asyncio.ensure_future(server.predict(image)) for image in images[:5]]
+        await asyncio.sleep(0)
+        stop = asyncio.ensure_future(server.stop())
+        # stop() has queued its sentinel, this request lands behind it
+        await asyncio.sleep(0)
+        late = asyncio.ensure_future(server.predict(images[5]))
+        await asyncio.wait_for(stop, 5)
+        assert server.executor is None
+        with pytest.raises(RuntimeError, match='server stopped'):
+            await asyncio.wait_for(late, 1)
+        return await asyncio.gather(*early)
+
+    outputs = asyncio.run(scenario())
+    np.testing.assert_allclose(np.stack(outputs), net.predict(images[:5], probs=True), rtol=1e-12)
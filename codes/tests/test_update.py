@@ -0,0 +1,38 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+from applications import MNISTNet
+from loss import L2, SoftmaxCrossEntropy
+from optimizers import SGD, Adam
+
+
+def update_peak(optimizer, regularization):
+    """Peak bytes allocated by an in-place update after a warm-up step"""
+    np.random.seed(0)
+    model = MNISTNet()
+    model.compile(optimizer, SoftmaxCrossEntropy(10), regularization)
+    model.flat_grads[...] = np.random.RandomState(0).randn(model.flat_grads.size)
+    model.update(optimizer, 1)
+    tracemalloc.start()
+    try:
+        model.update(optimizer, 2)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('optimizer', [SGD(lr=0.01, momentum=0.9, inplace=True), Adam(inplace=True)])
+def test_inplace_update_allocates_nothing_with_l2(optimizer):
+    # one flat parameter of MNISTNet is ~850 KB, a single temporary would show
+    assert update_peak(optimizer, L2(w=0.01)) < 4096
+
+
+def test_l2_accumulate_matches_backward():
+    rng = np.random.RandomState(0)
+    params = {'a': rng.randn(5, 3), 'b': rng.randn(7)}
+    grads = {k: rng.randn(*v.shape) for k, v in params.items()}
+    expected = {k: grads[k] + g for k, g in L2(w=0.1).backward(params).items()}
+    L2(w=0.1).accumulate(params, grads)
+    for k in params:
+        assert np.allclose(grads[k], expected[k])
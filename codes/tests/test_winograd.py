@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from layers import Convolution
+import winograd
+
+
+def run(backend, x, in_grads, pad, threads, layout):
+    np.random.seed(0)
+    layer = Convolution({'kernel_h': 3, 'kernel_w': 3, 'pad': pad, 'stride': 1, 'in_channel': x.shape[1], 'out_channel': 5,
+                         'backend': backend, 'threads': threads})
+    layer.set_layout(layout)
+    layer.set_cache(True)
+    if layout == 'CHWN':
+        x = np.ascontiguousarray(x.transpose(1, 2, 3, 0))
+        in_grads = np.ascontiguousarray(in_grads.transpose(1, 2, 3, 0))
+    outputs = layer.forward(x)
+    out_grads = layer.backward(in_grads, x)
+    if layout == 'CHWN':
+        outputs, out_grads = outputs.transpose(3, 0, 1, 2), out_grads.transpose(3, 0, 1, 2)
+    return outputs, out_grads, layer.w_grad.copy(), layer.b_grad.copy()
+
+
+@pytest.mark.parametrize('pad', [0, 1, 2])
+@pytest.mark.parametrize('height, width', [(8, 8), (7, 9), (5, 6)])
+@pytest.mark.parametrize('threads', [1, 3])
+@pytest.mark.parametrize('layout', ['NCHW', 'CHWN'])
+def test_winograd_matches_im2col(pad, height, width, threads, layout):
+    assert winograd.supported(3, 3, 1, pad)
+    rng = np.random.RandomState(pad * 100 + height * 10 + width)
+    x = rng.randn(4, 3, height, width)
+    out_shape = (4, 5, height + 2 * pad - 2, width + 2 * pad - 2)
+    in_grads = rng.randn(*out_shape)
+    expected = run('im2col', x, in_grads, pad, threads, layout)
+    actual = run('winograd', x, in_grads, pad, threads, layout)
+    for name, e, a in zip(('outputs', 'out_grads', 'w_grad', 'b_grad'), expected, actual):
+        assert a.shape == e.shape, name
+        np.testing.assert_allclose(a, e, rtol=1e-9, atol=1e-11, err_msg=name)
+
+
+def test_unsupported_geometries_fall_back_to_im2col():
+    assert not winograd.supported(3, 3, 2, 1)
+    assert not winograd.supported(5, 5, 1, 2)
+    assert not winograd.supported(3, 3, 1, 3)
+    layer = Convolution({'kernel_h': 3, 'kernel_w': 3, 'pad': 1, 'stride': 2, 'in_channel': 2, 'out_channel': 2, 'backend': 'winograd'})
+    assert layer.get_backend((2, 2, 8, 8)) == 'im2col'
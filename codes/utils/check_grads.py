@@ -1,3 +1,4 @@
+import copy
 import numpy as np 
 
 
@@ -72,28 +73,166 @@ def eval_numerical_gradient_loss(loss, inputs, targets, h=1e-5):
         it.iternext()
     return grads
 
+def eval_numerical_gradient_inputs_stacked(layer, inputs, in_grads, h=1e-5, chunk=256):
+    """Same result as eval_numerical_gradient_inputs, but perturbed copies of a sample are
+    stacked along the batch axis so one forward call evaluates up to `chunk` elements.
+    Only valid for layers that treat every sample independently (layer.independent_samples).
+    """
+    # the batch is the last axis of 4-D activations in the CHWN layout
+    axis = 3 if getattr(layer, 'layout', 'NCHW') == 'CHWN' and inputs.ndim == 4 else 0
+    inputs = np.moveaxis(inputs, axis, 0)
+    in_grads = np.moveaxis(in_grads, axis, 0)
+    batch = inputs.shape[0]
+    flat_inputs = inputs.reshape(batch, -1)
+    flat_in_grads = in_grads.reshape(batch, -1)
+    grads = np.zeros_like(flat_inputs)
+    size = flat_inputs.shape[1]
+    for n in range(batch):
+        for start in range(0, size, chunk):
+            idx = np.arange(start, min(start + chunk, size))
+            k = len(idx)
+            # rows [0, k) are shifted by +h, rows [k, 2k) by -h
+            stacked = np.repeat(flat_inputs[n:n+1], 2 * k, axis=0)
+            stacked[np.arange(k), idx] += h
+            stacked[np.arange(k, 2 * k), idx] -= h
+            stacked = np.ascontiguousarray(np.moveaxis(stacked.reshape((2 * k,) + inputs.shape[1:]), 0, axis))
+            outputs = np.moveaxis(layer.forward(stacked), axis, 0).reshape(2 * k, -1)
+            grads[n, idx] = np.matmul(outputs[:k] - outputs[k:], flat_in_grads[n]) / (2 * h)
+    return np.moveaxis(grads.reshape(inputs.shape), 0, axis)
+
+def eval_directional_gradients(func, arrays, grads, directions=16, h=1e-5, seed=None):
+    """Compare grads with finite differences of func along random directions (SPSA style)
+
+    Every direction is a random +-1 vector over all of `arrays`, scaled to unit length, so
+    the cost is two calls of func per direction however many elements there are.
+
+    # Arguments
+        func: callable without arguments returning a scalar, reads the arrays
+        arrays: list of numpy arrays, perturbed in place and restored afterwards
+        grads: list of numpy arrays, analytic gradients of func with respect to arrays
+        directions: int, the number of random directions
+        seed: int, seed for sampling the directions
+
+    # Returns
+        analytic: numpy array with shape (directions,), directional derivatives from grads
+        numeric: numpy array with shape (directions,), finite-difference directional derivatives
+    """
+    rng = np.random.RandomState(seed)
+    originals = [a.copy() for a in arrays]
+    analytic = np.zeros(directions)
+    numeric = np.zeros(directions)
+    for i in range(directions):
+        signs = [rng.choice([-1.0, 1.0], size=a.shape) for a in arrays]
+        # unit-length direction, so the step stays h however many elements move and rarely crosses a ReLU/max kink
+        norm = np.sqrt(sum(d.size for d in signs))
+        signs = [d / norm for d in signs]
+        analytic[i] = sum(np.sum(g * d) for g, d in zip(grads, signs))
+        for a, o, d in zip(arrays, originals, signs):
+            np.add(o, h * d, out=a)
+        pos = func()
+        for a, o, d in zip(arrays, originals, signs):
+            np.subtract(o, h * d, out=a)
+        neg = func()
+        for a, o in zip(arrays, originals):
+            np.copyto(a, o)
+        numeric[i] = (pos - neg) / (2 * h)
+    return analytic, numeric
+
 def check_grads(cacul_grads, numer_grads, threshold = 1e-7):
     precise = np.linalg.norm(cacul_grads-numer_grads) / max(np.linalg.norm(cacul_grads), np.linalg.norm(numer_grads))
     return precise
 
-def check_grads_layer(layer, inputs, in_grads):
-    numer_grads = eval_numerical_gradient_inputs(layer, inputs, in_grads)
-    cacul_grads = layer.backward(in_grads, inputs)
-
-    inputs_result = check_grads(cacul_grads, numer_grads)
+def check_grads_layer(layer, inputs, in_grads, dtype=np.float64, fast=False, directions=16):
+    """Print (and return) relative errors between analytic and numerical gradients
+
+    # Arguments
+        fast: bool, check inputs with batch-stacked perturbations and parameters
+            along random directions instead of one element at a time
+        directions: int, the number of random directions when fast
+    """
+    # finite differences need double precision, whatever dtype the model trains in; the check
+    # runs on a copy so the caller's layer (maybe holding views into Model.flat_params) is left as is
+    layer = copy.deepcopy(layer)
+    layer.set_dtype(dtype)
+    # the finite differences perturb inputs in place, a cache kept by the last perturbed
+    # forward pass would still count as made from them, so backward must recompute
+    layer.set_cache(False)
+    inputs = inputs.astype(dtype)
+    in_grads = in_grads.astype(dtype)
+    results = {}
+    # when the outputs of a sample depend on the rest of the batch (e.g. Dropout masks), stacking
+    # perturbed copies would change them: check the inputs element by element instead
+    stacked = fast and layer.independent_samples
+    if fast and not stacked:
+        print('%s does not treat samples independently, checking inputs element by element' % type(layer).__name__)
+    if stacked:
+        layer.forward(inputs)
+        cacul_grads = layer.backward(in_grads, inputs)
+        layer.clear_cache()
+        numer_grads = eval_numerical_gradient_inputs_stacked(layer, inputs, in_grads)
+    else:
+        numer_grads = eval_numerical_gradient_inputs(layer, inputs, in_grads)
+        cacul_grads = layer.backward(in_grads, inputs)
+
+    results['inputs'] = check_grads(cacul_grads, numer_grads)
     print('<1e-8 will be fine')
-    print('Gradients to inputs:', inputs_result)
+    print('Gradients to inputs:', results['inputs'])
     if layer.trainable:
-        w_grad, b_grad = eval_numerical_gradient_params(layer, inputs, in_grads)
-        w_results = check_grads(layer.w_grad, w_grad)
-        b_results = check_grads(layer.b_grad, b_grad)
-        print('Gradients to weights: ', w_results)
-        print('Gradients to bias: ', b_results)
-
-def check_grads_loss(layer, inputs, targets):
-    numer_grads = eval_numerical_gradient_loss(layer, inputs, targets)
-    cacul_grads = layer.backward(inputs, targets)
+        if fast:
+            func = lambda: np.sum(layer.forward(inputs) * in_grads)
+            analytic, numeric = eval_directional_gradients(func, [layer.weights, layer.bias], [layer.w_grad.copy(), layer.b_grad.copy()], directions)
+            results['params'] = check_grads(analytic, numeric)
+            print('Gradients to parameters (directional): ', results['params'])
+        else:
+            w_grad, b_grad = eval_numerical_gradient_params(layer, inputs, in_grads)
+            results['weights'] = check_grads(layer.w_grad, w_grad)
+            results['bias'] = check_grads(layer.b_grad, b_grad)
+            print('Gradients to weights: ', results['weights'])
+            print('Gradients to bias: ', results['bias'])
+    layer.clear_cache()
+    return results
+
+def check_grads_loss(layer, inputs, targets, dtype=np.float64, fast=False, directions=16):
+    # same as check_grads_layer: a copy without cache, so backward never reuses probabilities
+    # of a perturbed forward pass and the caller's loss is left as is
+    layer = copy.deepcopy(layer)
+    layer.set_cache(False)
+    inputs = inputs.astype(dtype)
+    if fast:
+        layer.forward(inputs, targets)
+        cacul_grads = layer.backward(inputs, targets)
+        layer.clear_cache()
+        func = lambda: layer.forward(inputs, targets)[0]
+        cacul_grads, numer_grads = eval_directional_gradients(func, [inputs], [cacul_grads], directions)
+    else:
+        numer_grads = eval_numerical_gradient_loss(layer, inputs, targets)
+        cacul_grads = layer.backward(inputs, targets)
 
     inputs_result = check_grads(cacul_grads, numer_grads)
     print('<1e-8 will be fine')
     print('inputs:', inputs_result)
+    layer.clear_cache()
+    return inputs_result
+
+def check_grads_model(model, inputs, targets, directions=16, h=1e-5, seed=None):
+    """Check the gradients of the whole model along random directions in model.flat_params
+
+    Every direction costs two Model.forward calls, which makes this cheap enough for
+    a test suite. The model should be compiled in float64 and contain no layer that
+    samples randomly on every forward pass. Regularization is not included.
+
+    # Returns
+        error: float, relative error between analytic and numerical directional derivatives
+    """
+    model.forward(inputs, targets)
+    model.backward(targets)
+    grads = model.flat_grads.copy()
+    func = lambda: model.forward(inputs, targets)[0]
+    analytic, numeric = eval_directional_gradients(func, [model.flat_params], [grads], directions, h, seed)
+    for layer in model.layers:
+        layer.clear_cache()
+    model.inputs = []
+    error = check_grads(analytic, numeric)
+    print('<1e-8 will be fine')
+    print('Model gradients (directional):', error)
+    return error
@@ -5,8 +5,21 @@ MNIST handwritten digits dataset.
 
 import numpy as np
 import os
+import queue
+import threading
 import wget
 
+def take(x, idx, out=None):
+    """x[idx] along the first axis; a run of consecutive indices becomes one contiguous block read"""
+    if len(idx) and idx[-1] - idx[0] == len(idx) - 1 and np.all(np.diff(idx) == 1):
+        block = x[idx[0]:idx[-1]+1]
+        if out is None:
+            return np.array(block)
+        out[...] = block
+        return out
+    return np.take(x, idx, axis=0, out=out)
+
+
 class MNIST():
 
     def __init__(self):
@@ -20,15 +33,40 @@ class MNIST():
         self.num_test = 0
         self.num_val = 0
 
-    def load(self, path='data/mnist.npz'):
+    def load(self, path='data/mnist.npz', dtype=np.float64, mmap=False):
         """Loads the MNIST dataset.
 
         # Arguments
             path: path where to cache the dataset locally
+            dtype: numpy dtype of the normalized images, e.g. np.float32
+            mmap: bool, store the normalized arrays once as raw .npy files next to path and memory-map them,
+                so later loads are close to instant and the images are read from disk on demand
 
         # Returns
             none
         """
+        if mmap:
+            x_train, y_train, x_test, y_test = self.load_mmap(path, dtype)
+        else:
+            x_train, y_train, x_test, y_test = self.load_npz(path, dtype)
+
+        self.num_train = int(x_train.shape[0] * 0.8)
+        self.num_val = x_train.shape[0] - self.num_train
+        self.num_test = x_test.shape[0]
+
+        self.x_train = x_train[:self.num_train]
+        self.y_train = y_train[:self.num_train]
+        self.x_val = x_train[self.num_train:]
+        self.y_val = y_train[self.num_train:]
+        self.x_test = x_test
+        self.y_test = y_test
+
+        print('Number of training images: ', self.num_train)
+        print('Number of validation images: ', self.num_val)
+        print('Number of testing images: ', self.num_test)
+
+    def load_npz(self, path, dtype):
+        """Read mnist.npz (downloading it if needed) and normalize the images into dtype"""
         if not os.path.exists(path):
             print('start download mnist dataset...')
             wget.download('https://s3.amazonaws.com/img-datasets/mnist.npz', out=path)
@@ -41,34 +79,47 @@ class MNIST():
         # x_train = (x_train-np.mean(x_train, axis=0, keepdims=True))/255
         # x_test = (x_test-np.mean(x_test, axis=0, keepdims=True))/255
 
-        x_train = x_train/255
-        x_test = x_test/255
+        x_train = np.divide(x_train, 255, dtype=dtype)
+        x_test = np.divide(x_test, 255, dtype=dtype)
 
         x_train_shape = x_train.shape
         x_test_shape = x_test.shape
         x_train = x_train.reshape(x_train_shape[0], 1, x_train_shape[1], x_train_shape[2])
         x_test = x_test.reshape(x_test_shape[0], 1, x_test_shape[1], x_test_shape[2])
+        return x_train, y_train, x_test, y_test
 
-        self.num_train = int(x_train.shape[0] * 0.8)
-        self.num_val = x_train.shape[0] - self.num_train
-        self.num_test = x_test.shape[0]
-
-        self.x_train = x_train[:self.num_train]
-        self.y_train = y_train[:self.num_train]
-        self.x_val = x_train[self.num_train:]
-        self.y_val = y_train[self.num_train:]
-        self.x_test = x_test
-        self.y_test = y_test
+    def load_mmap(self, path, dtype):
+        """Memory-map the normalized arrays, writing the .npy files from mnist.npz on first use"""
+        cache_dir = '%s_%s' % (os.path.splitext(path)[0], np.dtype(dtype).name)
+        names = ('x_train', 'y_train', 'x_test', 'y_test')
+        files = [os.path.join(cache_dir, name + '.npy') for name in names]
+        if not all(os.path.exists(f) for f in files):
+            arrays = self.load_npz(path, dtype)
+            os.makedirs(cache_dir, exist_ok=True)
+            for f, array in zip(files, arrays):
+                # write under a temporary name so an interrupted run never leaves a truncated file behind
+                np.save(f + '.tmp.npy', array)
+                os.replace(f + '.tmp.npy', f)
+        return tuple(np.load(f, mmap_mode='r') for f in files)
 
-        print('Number of training images: ', self.num_train)
-        print('Number of validation images: ', self.num_val)
-        print('Number of testing images: ', self.num_test)
+    def train_indices(self, batch, shuffle=True, seed=None):
+        """Endless generator of index arrays into the training set
 
-    def train_loader(self, batch, shuffle=True):
+        # Arguments
+            seed: int, seed of a private random generator, so the order does not depend on the global state (None to use np.random)
+        """
+        rng = np.random if seed is None else np.random.RandomState(seed)
         pointer = 0
+        order = None
         while True:
             if shuffle:
-                idx = np.random.choice(self.num_train, batch)
+                # sample without replacement: every epoch walks a fresh permutation
+                if order is None or pointer + batch > self.num_train:
+                    order = rng.permutation(self.num_train)
+                    pointer = 0
+                # ascending indices make the reads sequential, which matters for memory-mapped storage
+                idx = np.sort(order[pointer:pointer+batch])
+                pointer = pointer + batch
             else:
                 if pointer + batch <= self.num_train:
                     idx = np.arange(pointer, pointer+batch)
@@ -77,30 +128,123 @@ class MNIST():
                     pointer = 0
                     idx = np.arange(pointer, pointer+batch)
                     pointer = pointer + batch
-            yield self.x_train[idx], self.y_train[idx]
-    
-    def test_loader(self, batch):
+            yield idx
+
+    def test_indices(self, batch):
         pointer = 0
         while pointer+batch<=self.num_test:
             idx = np.arange(pointer, pointer+batch)
             pointer = pointer + batch
-            yield self.x_test[idx], self.y_test[idx]
-        if pointer<self.num_test-1:
-            idx = np.arange(pointer, self.num_test-pointer-1)
-            pointer = self.num_test-1
-            yield self.x_test[idx], self.y_test[idx]
-        else:
-            return None
+            yield idx
+        # the ragged last batch holds every remaining sample
+        if pointer<self.num_test:
+            yield np.arange(pointer, self.num_test)
 
-    def val_loader(self, batch):
+    def val_indices(self, batch):
         pointer = 0
         while pointer+batch<=self.num_val:
             idx = np.arange(pointer, pointer+batch)
             pointer = pointer + batch
-            yield self.x_val[idx], self.y_val[idx]
-        if pointer<self.num_val-1:
-            idx = np.arange(pointer, self.num_val-pointer-1)
-            pointer = self.num_val-1
-            yield self.x_val[idx], self.y_val[idx]
-        else:
-            return None
\ No newline at end of file
+            yield idx
+        # the ragged last batch holds every remaining sample
+        if pointer<self.num_val:
+            yield np.arange(pointer, self.num_val)
+
+    def train_loader(self, batch, shuffle=True, seed=None):
+        for idx in self.train_indices(batch, shuffle, seed):
+            yield take(self.x_train, idx), take(self.y_train, idx)
+    
+    def test_loader(self, batch):
+        for idx in self.test_indices(batch):
+            yield take(self.x_test, idx), take(self.y_test, idx)
+
+    def val_loader(self, batch):
+        for idx in self.val_indices(batch):
+            yield take(self.x_val, idx), take(self.y_val, idx)
+
+    def prefetch_loader(self, split, batch, depth=2, shuffle=True, seed=None):
+        """Loader of the 'train', 'val' or 'test' split that gathers the next batches in a background thread
+
+        # Arguments
+            depth: int, the number of batches prepared ahead of the training loop
+            shuffle, seed: same as in train_indices, only used for the 'train' split
+
+        # Returns
+            loader: PrefetchLoader, iterator of (x, y) batches
+        """
+        if split == 'train':
+            return PrefetchLoader(self.x_train, self.y_train, self.train_indices(batch, shuffle, seed), batch, depth)
+        if split == 'val':
+            return PrefetchLoader(self.x_val, self.y_val, self.val_indices(batch), batch, depth)
+        if split == 'test':
+            return PrefetchLoader(self.x_test, self.y_test, self.test_indices(batch), batch, depth)
+        raise ValueError('Unknown split: %s' % split)
+
+
+class PrefetchLoader():
+
+    def __init__(self, x, y, indices, batch, depth=2):
+        """Initialization, starts the background thread
+
+        Batches are gathered into a ring of depth+1 preallocated buffers. The
+        arrays returned by next() stay valid until the following call to next().
+
+        # Arguments
+            x, y: numpy arrays of samples and labels
+            indices: iterator of index arrays, one per batch (at most `batch` long)
+            batch: int, the largest batch size
+            depth: int, the number of batches prepared ahead
+        """
+        slots = depth + 1
+        self.x_buffers = np.empty((slots, batch) + x.shape[1:], dtype=x.dtype)
+        self.y_buffers = np.empty((slots, batch) + y.shape[1:], dtype=y.dtype)
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.current = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce, args=(x, y, indices), daemon=True)
+        self.thread.start()
+
+    def produce(self, x, y, indices):
+        try:
+            for idx in indices:
+                slot = None
+                while slot is None:
+                    if self.stopped.is_set():
+                        return
+                    try:
+                        slot = self.free.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                n = len(idx)
+                take(x, idx, out=self.x_buffers[slot, :n])
+                take(y, idx, out=self.y_buffers[slot, :n])
+                self.ready.put((slot, n))
+            self.ready.put(None)
+        except Exception as e:
+            self.ready.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # the previous batch has been consumed, its buffer can be refilled
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+        item = self.ready.get()
+        if item is None:
+            self.ready.put(None)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        slot, n = item
+        self.current = slot
+        return self.x_buffers[slot, :n], self.y_buffers[slot, :n]
+
+    def close(self):
+        """Stop the background thread"""
+        self.stopped.set()
+        self.thread.join()
@@ -45,8 +45,8 @@ class MSRA(Initializer):
     def initialize(self, size):
         return np.random.normal(0, math.sqrt(2/self.fan_in), size=size)
 
-def clip_gradients(in_grads, clip=1 ):
-    return np.clip(in_grads, -clip, clip)
+def clip_gradients(in_grads, clip=1, out=None):
+    return np.clip(in_grads, -clip, clip, out=out)
 
 def rel_error(x, y):
 	return np.mean(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+Winograd minimal filtering F(2x2, 3x3) for 3x3 stride-1 convolutions.
+
+The output is computed in 2x2 tiles from overlapping 4x4 input tiles:
+
+    Y = A^T [ (G w G^T) * (B^T d B) ] A
+
+where * is elementwise. The products for all tiles, input channels and
+output channels collapse into 16 independent (K, C) x (C, tiles) GEMMs,
+which take 16 multiplies per 2x2 output tile and channel pair instead of
+the 36 of direct convolution (2.25x fewer). The input transform writes
+4x4xC values per 2x2 tile, against the 9xC values per output pixel that
+im2col materializes.
+
+With numpy the transforms are separate memory-bound passes, and they cost
+more than the multiplies they save on the shapes in benchmarks/
+bench_winograd.py. This is why Convolution only uses this path when it is
+asked for.
+
+The gradient to the inputs of a stride-1 convolution is itself a stride-1
+convolution of the output gradients with the flipped, channel-transposed
+kernel, so it goes through the same code.
+"""
+
+import numpy as np
+
+G = np.array([
+    [1.0, 0.0, 0.0],
+    [0.5, 0.5, 0.5],
+    [0.5, -0.5, 0.5],
+    [0.0, 0.0, 1.0],
+])
+
+
+def supported(kernel_h, kernel_w, stride, pad):
+    """Whether a convolution geometry can go through the Winograd kernels"""
+    return kernel_h == 3 and kernel_w == 3 and stride == 1 and pad <= 2
+
+
+def filter_transform(weights):
+    """G w G^T for every (out_channel, in_channel) pair
+
+    # Arguments
+        weights: numpy array with shape (out_channel, in_channel, 3, 3)
+
+    # Returns
+        U: numpy array with shape (4, 4, out_channel, in_channel)
+    """
+    g = G.astype(weights.dtype)
+    return np.einsum('ij,kcjl,ml->imkc', g, weights, g)
+
+
+def input_transform(inputs, pad, tiles_h, tiles_w):
+    """B^T d B for every overlapping 4x4 tile d of the padded inputs
+
+    # Arguments
+        inputs: numpy array with shape (batch, in_channel, in_height, in_width)
+        pad: int, zero padding on every side
+        tiles_h, tiles_w: int, the number of 2x2 output tiles along each axis
+
+    # Returns
+        V: numpy array with shape (4, 4, batch, in_channel, tiles_h*tiles_w)
+    """
+    N, C, H, W = inputs.shape
+    # pad up to a whole number of tiles, the extra outputs are cropped afterwards
+    padded = np.zeros((N, C, 2 * tiles_h + 2, 2 * tiles_w + 2), dtype=inputs.dtype)
+    padded[:, :, pad:pad+H, pad:pad+W] = inputs
+
+    # B^T = [[1, 0, -1, 0], [0, 1, 1, 0], [0, -1, 1, 0], [0, 1, 0, -1]], applied along the
+    # width first (reading the contiguous input) and then along the height of every tile
+    c = [padded[..., k:k+2*tiles_w:2] for k in range(4)]
+    t = np.empty((4, N, C, 2 * tiles_h + 2, tiles_w), dtype=inputs.dtype)
+    np.subtract(c[0], c[2], out=t[0])
+    np.add(c[1], c[2], out=t[1])
+    np.subtract(c[2], c[1], out=t[2])
+    np.subtract(c[1], c[3], out=t[3])
+    r = [t[:, :, :, k:k+2*tiles_h:2] for k in range(4)]
+    V = np.empty((4, 4, N, C, tiles_h, tiles_w), dtype=inputs.dtype)
+    np.subtract(r[0], r[2], out=V[0])
+    np.add(r[1], r[2], out=V[1])
+    np.subtract(r[2], r[1], out=V[2])
+    np.subtract(r[1], r[3], out=V[3])
+    return V.reshape(4, 4, N, C, tiles_h * tiles_w)
+
+
+def output_transform(M, tiles_h, tiles_w):
+    """A^T m A for every tile, assembled into (batch, out_channel, 2*tiles_h, 2*tiles_w)"""
+    _, _, N, K, _ = M.shape
+    M = M.reshape(4, 4, N, K, tiles_h, tiles_w)
+    # A^T = [[1, 1, 1, 0], [0, 1, -1, -1]], applied along the height, then along the width
+    # straight into the interleaved output
+    t = np.empty((2, 4, N, K, tiles_h, tiles_w), dtype=M.dtype)
+    np.add(M[0], M[1], out=t[0])
+    t[0] += M[2]
+    np.subtract(M[1], M[2], out=t[1])
+    t[1] -= M[3]
+    outputs = np.empty((N, K, tiles_h, 2, tiles_w, 2), dtype=M.dtype)
+    for a in range(2):
+        left, right = outputs[:, :, :, a, :, 0], outputs[:, :, :, a, :, 1]
+        np.add(t[a, 0], t[a, 1], out=left)
+        left += t[a, 2]
+        np.subtract(t[a, 1], t[a, 2], out=right)
+        right -= t[a, 3]
+    return outputs.reshape(N, K, 2 * tiles_h, 2 * tiles_w)
+
+
+def conv2d(inputs, weights, bias=None, pad=0, U=None):
+    """3x3 stride-1 convolution, same result as the im2col path of layers.Convolution
+
+    # Arguments
+        inputs: numpy array with shape (batch, in_channel, in_height, in_width)
+        weights: numpy array with shape (out_channel, in_channel, 3, 3)
+        bias: numpy array with shape (out_channel,) or None
+        pad: int, zero padding on every side
+        U: numpy array, filter_transform(weights) if already computed
+
+    # Returns
+        outputs: numpy array with shape (batch, out_channel, out_height, out_width)
+    """
+    N, C, H, W = inputs.shape
+    h_out = H + 2 * pad - 2
+    w_out = W + 2 * pad - 2
+    tiles_h = (h_out + 1) // 2
+    tiles_w = (w_out + 1) // 2
+    if U is None:
+        U = filter_transform(weights)
+    V = input_transform(inputs, pad, tiles_h, tiles_w)
+    # 16 GEMMs (out_channel, in_channel) x (in_channel, tiles), broadcast over the batch
+    M = np.matmul(U[:, :, None], V)
+    outputs = output_transform(M, tiles_h, tiles_w)[:, :, :h_out, :w_out]
+    if bias is not None:
+        outputs += bias.reshape(1, -1, 1, 1)
+    return outputs
+
+
+def conv2d_input_grads(in_grads, weights, pad=0):
+    """Gradients to the inputs of conv2d(inputs, weights, pad=pad)
+
+    # Arguments
+        in_grads: numpy array with shape (batch, out_channel, out_height, out_width)
+        weights: numpy array with shape (out_channel, in_channel, 3, 3)
+        pad: int, the padding of the forward convolution (at most 2)
+
+    # Returns
+        out_grads: numpy array with shape (batch, in_channel, in_height, in_width)
+    """
+    flipped = weights[:, :, ::-1, ::-1].transpose(1, 0, 2, 3)
+    return conv2d(in_grads, flipped, pad=2 - pad)